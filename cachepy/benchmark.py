@@ -0,0 +1,224 @@
+
+"""
+benchmark suite for cachepy
+
+measures the performance characteristics we care about when deploying a cache:
+    hit latency and miss overhead of AbstractCache
+    contention when many threads or processes hammer the same cache
+    the cost of deeper key hierarchies
+    scaling with key and value size, including large ndarrays
+    open and lookup time of a ReadOnlyShelve
+    throughput of as_deterministic
+
+every measurement is emitted as a single json record on its own line,
+tagged with the platform, python and numpy versions and the git revision if available,
+so that results of different versions can simply be concatenated and compared
+
+usage:
+    python benchmark.py [outputfile] [--quick]
+"""
+
+import os
+import sys
+import json
+import platform
+import tempfile
+import subprocess
+from time import time
+
+import numpy as np
+
+from cache import AbstractCache
+from readonlyshelve import ReadOnlyShelve
+from serialization import as_deterministic
+
+
+def identity(*args):
+    return args[0] if args else None
+
+def make_array(size):
+    return np.ones(size, dtype=np.uint8)
+
+def make_string(size):
+    return 'x' * size
+
+
+def revision():
+    """git revision of the code being benchmarked, if we can find it"""
+    try:
+        root = os.path.dirname(os.path.abspath(__file__))
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root, stderr=devnull).strip()
+    except Exception:
+        return None
+
+def context():
+    return dict(
+        python      = platform.python_version(),
+        platform    = platform.platform(),
+        numpy       = np.__version__,
+        revision    = revision(),
+        time        = time())
+
+
+def measure(func, number):
+    """
+    call func number times, and return the seconds per call
+    func receives the iteration index, so it can generate distinct keys
+    """
+    start = time()
+    for i in xrange(number):
+        func(i)
+    return (time() - start) / number
+
+
+_identifiers = []
+def make_cache(name, **kwargs):
+    """create a fresh cache with a unique identifier for benchmarking purposes"""
+    identifier = 'benchmark_%s_%i' % (name, os.getpid())
+    _identifiers.append(identifier)
+    kwargs.setdefault('operation', identity)
+    return AbstractCache(identifier=identifier, environment=name, connect_clear=True, **kwargs)
+
+
+def bench_hit(number):
+    cache = make_cache('hit')
+    cache(0)
+    yield dict(name='hit', seconds=measure(lambda i: cache(0), number))
+
+def bench_miss(number):
+    compute = measure(lambda i: identity(i), number)
+    for write_behind in [False, True]:
+        cache = make_cache('miss_%i' % write_behind, write_behind=write_behind)
+        miss = measure(lambda i: cache(i), number)
+        cache.flush()
+        yield dict(name='miss', write_behind=write_behind, seconds=miss, overhead=miss - compute)
+
+def bench_hierarchy(number, depths=(1, 2, 4, 8)):
+    for depth in depths:
+        cache = make_cache('hierarchy_%i' % depth, hierarchy=[[i] for i in range(depth)])
+        args = range(depth)
+        cache(*args)
+        yield dict(name='hierarchy', depth=depth, seconds=measure(lambda i: cache(*args), number))
+
+def bench_keysize(number, sizes=(10, 1000, 100000)):
+    for size in sizes:
+        cache = make_cache('keysize_%i' % size)
+        for kind, key in [('str', make_string(size)), ('ndarray', make_array(size)), ('list', range(size // 10))]:
+            cache(key)
+            yield dict(name='keysize', kind=kind, size=size, seconds=measure(lambda i: cache(key), number))
+
+def bench_valuesize(number, sizes=(10, 1000, 100000, 10000000)):
+    for size in sizes:
+        cache = make_cache('valuesize_%i' % size, operation=make_array)
+        miss = measure(lambda i: cache(size + i), 1)
+        hit = measure(lambda i: cache(size), number)
+        yield dict(name='valuesize', size=size, miss=miss, seconds=hit)
+
+
+#contention workers need to be importable from child processes; caches are created per process
+_worker_cache = None
+def _init_worker(identifier):
+    global _worker_cache
+    _worker_cache = AbstractCache(identifier=identifier, environment='contention', operation=identity)
+
+def _work(arg):
+    start = time()
+    _worker_cache(arg)
+    return time() - start
+
+def bench_contention(number, workers=(1, 2, 4), keys=8):
+    import multiprocessing
+    import multiprocessing.dummy
+    for mode, module in [('threads', multiprocessing.dummy), ('processes', multiprocessing)]:
+        for n in workers:
+            cache = make_cache('contention_%s_%i' % (mode, n))
+            pool = module.Pool(n, _init_worker, (cache.identifier,))
+            args = [i % keys for i in range(number)]
+            start = time()
+            latencies = pool.map(_work, args)
+            elapsed = time() - start
+            pool.close()
+            pool.join()
+            yield dict(
+                name        = 'contention',
+                mode        = mode,
+                workers     = n,
+                seconds     = float(np.median(latencies)),
+                worst       = max(latencies),
+                throughput  = number / elapsed)
+
+def bench_readonly(number, sizes=(100, 10000)):
+    for size in sizes:
+        filename = tempfile.mktemp()
+        try:
+            ReadOnlyShelve.build(filename, [((i, 'key'), make_string(100)) for i in range(size)])
+            opened = measure(lambda i: ReadOnlyShelve(filename), 3)
+            shelve = ReadOnlyShelve(filename)
+            lookup = measure(lambda i: shelve[(i % size, 'key')], number)
+            yield dict(name='readonly', size=size, open=opened, seconds=lookup)
+        finally:
+            os.remove(filename)
+
+class Node(object):
+    """minimal user defined type, as found in expression graphs"""
+    def __init__(self, value, children):
+        self.value = value
+        self.children = children
+
+def bench_deterministic(number):
+    objects = [
+        ('flat',    tuple(range(100))),
+        ('dict',    {str(i): i for i in range(100)}),
+        ('nested',  [{'a': (i, str(i)), 'b': set(range(5))} for i in range(20)]),
+        ('user',    Node(1, [Node(i, []) for i in range(20)])),
+        ('ndarray', np.arange(100000)),
+        ]
+    for kind, obj in objects:
+        seconds = measure(lambda i: as_deterministic(obj), number)
+        yield dict(name='as_deterministic', kind=kind, seconds=seconds, bytes=len(as_deterministic(obj)))
+
+
+benchmarks = [
+    bench_hit,
+    bench_miss,
+    bench_hierarchy,
+    bench_keysize,
+    bench_valuesize,
+    bench_contention,
+    bench_readonly,
+    bench_deterministic,
+    ]
+
+
+def run(output=sys.stdout, number=1000, select=None):
+    """
+    run all benchmarks, or those whose name contains select, and write json lines to output
+    """
+    ctx = context()
+    try:
+        for bench in benchmarks:
+            if select and select not in bench.__name__:
+                continue
+            for result in bench(number):
+                result.update(ctx)
+                output.write(json.dumps(result, sort_keys=True) + '\n')
+                output.flush()
+    finally:
+        import cache
+        for identifier in _identifiers:
+            for suffix in ['', '.lock']:
+                try:
+                    os.remove(os.path.join(cache.cachepath, identifier + suffix))
+                except OSError:
+                    pass
+
+
+if __name__=='__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    number = 50 if '--quick' in sys.argv else 1000
+    if args:
+        with open(args[0], 'a') as output:
+            run(output, number)
+    else:
+        run(sys.stdout, number)
@@ -38,6 +38,44 @@ validation mode:
     all cached calls are both read from the database as well as recomputed, and then checked for correctness
     this is useful to check the correctness of this code, as well as checking the correctness of ones'
     environment implementation
+    since this doubles the cost of every hit, a fraction of hits may be sampled instead,
+    optionally validated on a background thread, so it can be left enabled in production
+    failures are reported to a callback, and the offending entry may be quarantined
+
+
+expiry:
+    values may be given a time to live, per cache or per entry, for operations depending on
+    slowly changing inputs which are deliberately left out of the environment
+    in stale-while-revalidate mode, expired values are returned immediately, while a single caller
+    refreshes them in the background; the deferred token doubles as the claim on the refresh
+
+
+failures:
+    when the operation raises, its deferred token is removed immediately, so waiting callers
+    recompute rather than wait for the deferred timeout. exceptions of selected types may be cached
+    for a given time instead; waiters and later callers then get the same error without recomputing
+
+
+write behind:
+    upon a miss, the caller normally waits for the value to be pickled, compressed and committed
+    in write behind mode, the value is returned right away, and a background thread commits pending
+    values in batches, each in a single transaction. other threads of the same process are served from
+    the pending values in the meantime; other processes see the deferred token until it is committed
+    flush() blocks until all pending values are on disk; it is invoked at interpreter exit as well.
+    independently of this, values are committed in groups; the partial keys and deferred token of a miss
+    are committed as a single transaction before the lock is released, the value itself shortly after
+    if the writer fails, the deferred tokens are removed, so nobody waits for values which never arrive.
+    if the process dies outright, the tokens expire after deferred_timeout, as they would mid-computation
+
+
+
+processes:
+    a cache may be created before forking worker processes, for instance by multiprocessing.Pool;
+    the worker threads, connections and locks of a cache do not survive a fork, and are recreated lazily
+    in the child. values the parent has yet to commit are not visible to children, so call prepare_fork()
+    before forking if that matters. caches are pickled by identifier and constructor arguments,
+    rather than by content, so they may also be passed to pool workers cheaply; a worker reuses
+    the instance it already has
 
 
 
@@ -71,6 +109,7 @@ different scenarios will call for different shelve designs:
     different locking strategies
     local/server based
     on disk / in memory
+shelves.select_mapping picks one of these; pass its arguments as the mapping of a cache
 
 
 locking:
@@ -82,31 +121,46 @@ why this is still primarily a compilation caching project, rather than a general
     correctness is emphasized over performance, that is,
     it is assumed that the stored data has a high compute intensity
     that said, once the code is generalized enough, we may just as well select
-    a nondeterministic serialization and an in-memory store to get an efficient memoize function
+    a nondeterministic serialization and an in-memory store to get an efficient memoize function;
+    which is what the memory module does
 
 """
 
 
 
 import os
+import sys
+import functools
+import cPickle as pickle
+import util
 
 import tempfile
-from shelve2 import Shelve, process_key, encode
+import shelve2
+from shelve2 import Shelve, process_key, encode, decode, decode_key
 from time import clock, sleep, time
 
 import threading
+import atexit
+import weakref
+import logging
+from random import random
 
 
 import numpy as np
 import inspect
 from serialization import as_deterministic
+import canonical
+from metrics import select_metrics
 
 
 import lockfile.mkdirlockfile as lockfile
+from locking import NullLock
 
 lock_thread = True
 lock_file = True
 
+logger = logging.getLogger('cachepy')
+
 
 temppath = tempfile.gettempdir()
 cachepath = os.path.join(temppath, 'cachepy')
@@ -125,9 +179,11 @@ class Deferred(object):
     placed in database to inform other threads/processes an entry is under construction
     this prevents unnecessary duplication of work in the case of multiple threads/processes
     demanding the same cached value at similar times
+    when an expired value is being refreshed, it is kept as stale, to be served in the meantime
     """
-    def __init__(self):
+    def __init__(self, stale=None):
         self.stamp = time()
+        self.stale = stale
     def expired(self, timeout):
         dt = time() - self.stamp
         return dt > timeout or dt < 0
@@ -148,11 +204,113 @@ class Partial(object):
     def __repr__(self):
         return str(self)
 
+canonical.register(Partial, 'cachepy.Partial', lambda p: p.rowid, Partial)
+
+class Expiring(object):
+    """
+    timestamped value with a limited lifetime
+    an operation may wrap its return value in an Expiring object to give it a time to live of its own,
+    overriding the ttl of the cache
+    """
+    def __init__(self, value, ttl):
+        self.value = value
+        self.ttl = ttl
+        self.stamp = time()
+    def expired(self):
+        dt = time() - self.stamp
+        return dt > self.ttl or dt < 0
+    def __str__(self):
+        return 'Expiring Value: ' + str(self.stamp) + ' + ' + str(self.ttl)
+    def __repr__(self):
+        return str(self)
+
+
+
+class CachedException(Exception):
+    """stands in for a cached exception which could not be pickled"""
+
+class Failure(object):
+    """
+    timestamped record of an exception raised by the operation
+    placed in the database in place of a value, such that waiters and subsequent callers
+    get the error right away, rather than all failing in turn
+    """
+    def __init__(self, exception, ttl):
+        import traceback
+        self.traceback = traceback.format_exc()
+        try:
+            #exceptions with an __init__ of their own may pickle fine, yet fail to unpickle
+            pickle.loads(pickle.dumps(exception, util.pickle_protocol))
+            self.exception = exception
+        except Exception:
+            self.exception = CachedException('%s: %s' % (type(exception).__name__, exception))
+        self.ttl = ttl
+        self.stamp = time()
+    def expired(self):
+        if self.ttl is None:
+            return False
+        dt = time() - self.stamp
+        return dt > self.ttl or dt < 0
+    def reraise(self):
+        self.exception.cached_traceback = self.traceback
+        raise self.exception
+    def __str__(self):
+        return 'Failure: ' + repr(self.exception)
+    def __repr__(self):
+        return str(self)
+
+
+
+#all caches of this process, by type and identifier
+_instances = weakref.WeakValueDictionary()
+#caches of this process with threads or writes to wind down at exit; held weakly, so as not to keep them alive
+_exiting = weakref.WeakSet()
+exit_timeout = 10       #seconds to wait for each of them at exit
+
+@atexit.register
+def _shutdown():
+    """flush all caches and stop their threads, before interpreter shutdown pulls the rug from under them"""
+    for cache in list(_exiting):
+        try:
+            cache._shutdown(exit_timeout)
+        except Exception:
+            logger.exception('Shutting down cache %s failed', cache.identifier)
+
+def prepare_fork():
+    """
+    flush all caches of this process before forking it, such that forked children see all values computed so far
+    """
+    for cache in _instances.values():
+        cache.flush()
+    shelve2.prepare_fork()
+
+def _restore(cls, identifier, kwargs):
+    """unpickle a cache; by reusing the instance already present in this process, if any"""
+    try:
+        return _instances[cls, identifier]
+    except KeyError:
+        return cls(**kwargs)
+
+def _restore_decorated(module, name):
+    """unpickle the cache of a decorated function, by importing its module"""
+    import importlib
+    return getattr(importlib.import_module(module), name).cache
+
+
+
+def report_invalid(cache, args, kwargs, value, newvalue):
+    """default validation failure handler; log the offending call"""
+    logger.error(
+        'Cache %s returned invalid value!\narguments: %r %r\ncached value: %r\nrecomputed value: %r',
+        cache.identifier, args, kwargs, value, newvalue)
+
 
 
 class AbstractCache(object):
     """
     abstract base class of a cache object which gracefully handles large arbitrary key objects
+    large graphs are best passed as nodes implementing the merkle protocol of the serialization module,
+    or directly as their serialization.Digest; both are keyed identically
     """
     def __init__(
             self,
@@ -160,48 +318,144 @@ class AbstractCache(object):
             environment         = None,     #object containing information regarding the dependencies on global state of the cached operation
             operation           = None,     #function to be cached. note that the order of arguments is significant for key reuse
             hierarchy           = None,     #key hierarchy; if and how args and kwargs are hierarchically ordered
-            validate            = False,    #validation mode. if enabled, all cache retrievals are checked against a recomputed function call.
+            validate            = False,    #validation mode. if enabled, all cache retrievals are checked against a recomputed function call. a float validates only that fraction of retrievals
+            validate_async      = False,    #perform validation on a background thread, rather than delaying the caller
+            on_invalid          = None,     #callback(cache, args, kwargs, value, newvalue) invoked upon a validation failure. defaults to logging an error
+            quarantine          = False,    #remove entries which failed validation from the cache
             deferred_timeout    = 30,       #time to wait before a deferred object is considered obsolete. compilation may take a long time; that said, it may also crash your process...
             lock_timeout        = 1,        #time to wait before a lock is considered obsolete. the lock is needed for pure db transactions only; this makes once second a long time
             environment_clear   = True,     #clear the cache upon connection with a novel environment key
-            connect_clear       = False     #clear the cache upon every connection
+            connect_clear       = False,    #clear the cache upon every connection
+            metrics             = None,     #instrumentation; True to collect statistics, or a metrics.Metrics object to collect them into
+            track_dependencies  = False,    #include the functions and constants the operation depends upon in the environment. True tracks the package of the operation, or pass a list of package names
+            ttl                 = None,     #time to live of cached values in seconds. None means forever. the operation may return an Expiring value to override it
+            stale_while_revalidate = False, #return expired values immediately, while a single caller refreshes them in the background
+            cache_exceptions    = None,     #dict mapping exception types raised by the operation to the time in seconds they are cached for, or None for forever. a time of zero only informs current waiters
+            write_behind        = False,    #return computed values before they are committed; a background thread writes them in batches
+            commit_window       = 0.01,     #computed values written within this many seconds are committed as a group. None commits every statement
+            server              = None,     #address of a cache server to use instead of a local database; a (host, port) tuple or a unix socket path. see the server module
+            shards              = None,     #split the database over this many files, each with a lock of its own. see the sharding module
+            maintenance         = None,     #seconds between rounds of background maintenance of the database, which returns free space to the filesystem. see the maintenance module
+            trace               = None,     #record the calls to this cache, their frequency and cost, for warming up a fresh cache. True or a filename. see the tracing module
+            preload             = False,    #load the entries of the current environment into memory at startup, in sequential scans. an int loads only that many of the hottest calls of the trace, which requires trace. ignored when validating
+            preload_background  = False,    #preload on a separate thread; lookups go to the database until it is done
+            database            = None,     #name of a database file to share with other caches, each using a table of its own. defaults to a file per cache
+            dedup               = False,    #store each distinct value only once per database, referring to it by digest; also across caches sharing the database
+            mapping             = None,     #dict of keyword arguments to shelves.select_mapping, trading features of the store for speed. defaults to an sqlite shelve with all of them
             ):
         """
         if environment_clear is set to true, the cache is cleared
         """
+        self._init_args = dict((k, v) for k, v in locals().items() if k != 'self')
+        if preload is not True and preload and not trace:
+            raise ValueError('preload=%r loads the hottest calls of the trace; pass trace as well, or preload=True' % (preload,))
         if identifier: self.identifier = identifier
         if operation: self.operation = operation
         self.hierarchy = hierarchy
         #add some essentials to the environment
         import platform
-        globalenv               = platform.architecture(), platform.python_version()
-        funcenv                 = inspect.getargspec(self.operation), inspect.getsource(self.operation)
+        #keys are encoded canonically, so only the major python version is relevant
+        globalenv               = platform.architecture(), platform.python_implementation(), sys.version_info[0]
+        if track_dependencies:
+            import dependencies
+            packages            = None if track_dependencies is True else track_dependencies
+            funcenv             = tuple(inspect.getargspec(self.operation)), dependencies.fingerprint(self.operation, packages)
+        else:
+            funcenv             = tuple(inspect.getargspec(self.operation)), inspect.getsource(self.operation)
         self.environment        = globalenv, funcenv, (environment if environment else self.environment())
-        estr, ehash             = process_key(self.environment)
 
-        self.validate           = validate
+        self.validate           = float(validate)
+        self.validate_async     = validate_async
+        self.on_invalid         = on_invalid if on_invalid else report_invalid
+        self.quarantine         = quarantine
+        self.validation_pool    = None
         self.lock_timeout       = lock_timeout
         self.deferred_timeout   = deferred_timeout
-
-        self.filename           = os.path.join(cachepath, self.identifier)
-        self.shelve             = Shelve(self.filename, autocommit = True)
+        self.metrics            = select_metrics(metrics, self.identifier)
+        self.ttl                = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.cache_exceptions   = cache_exceptions if cache_exceptions else {}
+        self.write_behind       = write_behind
+        self.pending            = {}        #str of keystr -> (leafkey, keystr, keyhash, value) awaiting the background writer
+        self.pending_changed    = threading.Condition(threading.Lock())
+        self.writer             = None
+
+        self.filename           = os.path.join(cachepath, database if database else self.identifier)
+        tablename               = self.identifier if database else 'dict'
+        self.server             = server
+        if server:
+            from server import RemoteShelve
+            self.shelve         = RemoteShelve(server, self.identifier, metrics = self.metrics)
+            commit_window       = None      #the server takes care of that
+        elif shards:
+            from sharding import ShardedShelve
+            self.shelve         = ShardedShelve(self.filename, shards, lock_timeout = lock_timeout, metrics = self.metrics,
+                                                autocommit = True, commit_window = commit_window, tablename = tablename, dedup = dedup)
+        elif mapping:
+            from shelves import select_mapping
+            self.shelve         = select_mapping(**mapping)(self.filename, autocommit = True, metrics = self.metrics,
+                                                            commit_window = commit_window, tablename = tablename, dedup = dedup)
+        else:
+            self.shelve         = Shelve(self.filename, autocommit = True, metrics = self.metrics, commit_window = commit_window,
+                                         tablename = tablename, dedup = dedup)
+        #a wrapped mapping may encode its keys its own way, and do without the hierarchy
+        self.encode_key         = getattr(self.shelve, 'encode_key', canonical.encode)
+        self.process_key        = getattr(self.shelve, 'process_key', process_key)
+        if not getattr(self.shelve, 'hierarchical', True):
+            self.hierarchy      = None
+        self.readonly           = getattr(self.shelve, 'readonly', False)
         self.lock               = threading.Lock()
-        self.lock_file          = lockfile.MkdirLockFile(self.filename, timeout = lock_timeout)
+        self.lock_file          = self._lockfile()
+        self.pid                = os.getpid()
 
-        with self.lock, self.lock_file:
-            if connect_clear:
-                #this isnt right; we are now invalidating the precomputed envrowid of other processes...
-                self.shelve.clear()           #need write lock here
+        if self.readonly:
+            #a prebuilt store holds no environment row; whoever built it vouches for the environment
+            self.envrowid       = None
+        else:
+            estr, ehash         = self.process_key(self.environment)
+            with self.lock, self.lock_file:
+                if connect_clear:
+                    #this isnt right; we are now invalidating the precomputed envrowid of other processes...
+                    self.shelve.clear()           #need write lock here
 
-            #write environment key to database and obtain its unique rowid
-            try:
-                self.envrowid = self.shelve.getrowid(self.environment, estr, ehash)
-            except:
-                #connect to the db with a novel environment; probably wont change back again
-                if environment_clear:
-                    self.shelve.clear()         #need write lock here
-                self.shelve.setitem(self.environment, None, estr, ehash)
-                self.envrowid = self.shelve.getrowid(self.environment, estr, ehash)
+                #write environment key to database and obtain its unique rowid
+                try:
+                    self.envrowid = self.shelve.getrowid(self.environment, estr, ehash)
+                except:
+                    #connect to the db with a novel environment; probably wont change back again
+                    if environment_clear:
+                        self.shelve.clear()         #need write lock here
+                    self.shelve.setitem(self.environment, None, estr, ehash)
+                    self.envrowid = self.shelve.getrowid(self.environment, estr, ehash)
+                self.shelve.commit().wait()
+        self.grouped            = commit_window is not None
+        if self.grouped:
+            #do not leave a group of values uncommitted at exit
+            _exiting.add(self)
+        self.trace              = None
+        if trace:
+            from tracing import Trace
+            self.trace          = Trace(os.path.join(cachepath, self.identifier + '.trace') if trace is True else trace)
+        self.memory             = None      #preloaded entries; see preload
+        #preloading decodes entries as stored by a shelve with all its features
+        preloadable = hasattr(self.shelve, 'iterraw') and all(
+            getattr(self.shelve, feature, True) for feature in ('exact', 'deterministic', 'zip'))
+        if preload and not self.validate and preloadable:
+            limit               = None if preload is True else preload
+            if preload_background:
+                loader          = threading.Thread(target = self.preload, args = (limit,))
+                loader.daemon   = True
+                loader.start()
+            else:
+                self.preload(limit)
+        self.maintenance        = []
+        if maintenance and not server and (shards or hasattr(self.shelve, 'space')):
+            #a server maintains its own databases, and a wrapped mapping is not necessarily a database
+            from maintenance import Maintenance
+            shelves = [shard.shelve for shard in self.shelve.shards] if shards else [self.shelve]
+            self.maintenance    = [Maintenance(shelve, interval = maintenance, metrics = self.metrics) for shelve in shelves]
+            _exiting.add(self)
+        _instances[type(self), self.identifier] = self
 
 
 
@@ -211,6 +465,8 @@ class AbstractCache(object):
         look up a hierachical key object
         fill in the missing parts, and perform the computation at the leaf if so required
         """
+        if self.pid != os.getpid():
+            self._after_fork()
         if self.hierarchy:
             #apply the structure in hierarchy to the arguments
             fkey = kwargs.copy()
@@ -219,49 +475,91 @@ class AbstractCache(object):
             if fkey: hkey.append(fkey)  #any arguments not part of the hierarchy spec are placed at the end
         else:
             hkey = [args + ((kwargs,) if kwargs else ())]   #put all args in a single key
+        metrics = self.metrics
         #preprocess subkeys. this minimizes time spent in locked state
-        hkey = map(as_deterministic, hkey)
-
-        with self.lock:     #fairly stupid thread locking. dont use threads; how about that?
+        with metrics.span('serialize'):
+            hkey = map(self.encode_key, hkey)
+        trace = self.trace
+        if trace is not None:
+            tracekey = canonical.digest(tuple(hkey))
+            trace.record(tracekey, args, kwargs)
+        if self.memory is not None:
+            try:
+                value = self._recall(hkey)
+            except KeyError:
+                pass
+            else:
+                metrics.count('hit')
+                metrics.count('preloaded')
+                return value
+
+        with metrics.timed(self.lock, 'lock_thread'):     #fairly stupid thread locking. dont use threads; how about that?
+            waiting = None      #time at which we started waiting for a deferred value
+            failure = None
+            validating = None   #hit to be validated, outside of the try block
             while True:
                 try:
-                    with self.lock_file:
+                    with metrics.timed(self.lock_file, 'lock_file'):
                         #hierarchical key lookup; first key is prebound environment key
                         previouskey = Partial(self.envrowid)
                         for ikey, subkey in enumerate(hkey[:-1]):
                             partialkey = previouskey, subkey
-                            rowid = self.shelve.getrowid(partialkey, *process_key(partialkey))  #read lock?
+                            rowid = self.shelve.getrowid(partialkey, *self.process_key(partialkey))  #read lock?
                             previouskey = Partial(rowid)
                         #leaf iteration
                         ikey = len(hkey)-1
                         leafkey = previouskey, hkey[-1]
-                        value = self.shelve[leafkey]                                            #read lock?
+                        kstr, khash = self.process_key(leafkey)
+                        value = self.shelve.getitem(leafkey, kstr, khash)                      #read lock?
+
+                    if isinstance(value, Deferred) and self.pending:
+                        #our own value may still be on its way to disk
+                        value = self.pending.get(str(kstr), (None, None, None, value))[3]
 
                     if isinstance(value, Deferred):
+                        if value.stale is not None and self.stale_while_revalidate:
+                            metrics.count('stale')
+                            if value.expired(self.deferred_timeout):
+                                #whoever was refreshing it did not make it
+                                self._revalidate(leafkey, value, args, kwargs)
+                            return value.stale.value
+                        if waiting is None:
+                            waiting = time()
+                            metrics.count('deferred')
                         if value.expired(self.deferred_timeout):
+                            metrics.count('deferred_expired')
+                            raise Exception()
+                        self.shelve.wait(leafkey, kstr, khash, value.stamp + self.deferred_timeout - time())
+                    elif isinstance(value, Failure):
+                        if waiting is None and value.expired():
+                            metrics.count('failure_expired')
                             raise Exception()
-                        sleep(0.01)
+                        #raise it outside of the try block
+                        failure = value
+                        break
+                    elif isinstance(value, Expiring) and value.expired():
+                        if not self.stale_while_revalidate:
+                            metrics.count('expired')
+                            raise Exception()
+                        metrics.count('stale')
+                        self._revalidate(leafkey, value, args, kwargs)
+                        return value.value
                     else:
-                        if self.validate:
-                            #check if recomputed value is identical under deterministic serialization
-                            newvalue = self.operation(*args, **kwargs)
-
-                            try:
-                                #note; new may differ from old in case aliasing in an ndarray was erased
-                                #by original serialization. is this an error?
-                                #id say so; depending on wether we have a cache hit, downstream code may react diffently
-                                #perhaps its best to use custom serializating for values too
-                                assert(as_deterministic(value)==as_deterministic(newvalue))
-                            except:
-                                print 'Cache returned invalid value!'
-                                print 'arguments:'
-                                print args
-                                print kwargs
-                                print 'cached value'
-                                print value
-                                print 'recomputed value'
-                                print newvalue
-                                quit()
+                        if isinstance(value, Expiring):
+                            value = value.value
+                        if waiting is not None:
+                            metrics.observe('deferred_wait', time() - waiting)
+                        metrics.count('hit')
+                        if self.validate and random() < self.validate:
+                            if self.validate_async:
+                                if self.validation_pool is None:
+                                    import multiprocessing.dummy
+                                    self.validation_pool = multiprocessing.dummy.Pool(1)
+                                self.validation_pool.apply_async(self._validate, (value, leafkey, args, kwargs, True))
+                            else:
+                                #errors of on_invalid are for the caller to see, rather than to pass for a miss
+                                validating = value, leafkey
+                                break
 
                         #yes! hitting this return is what we are doing this all for!
                         return value
@@ -270,32 +568,397 @@ class AbstractCache(object):
                     #lock for the writing branch. multiprocess does not benefit here, but so be it.
                     #worst case we make multiple insertions into db, but this should do no harm for behavior
 
+                    if self.readonly:
+                        #a prebuilt store is not ours to fill in; compute without storing
+                        metrics.count('miss')
+                        return self.operation(*args, **kwargs)
                     if self.lock_file.is_locked():
                         #if lock not available, better to go back to waiting for a deferred to appear
+                        metrics.count('lock_busy')
                         sleep(0.001)
                     else:
-                        with self.lock_file:
+                        metrics.count('miss')
+                        with metrics.timed(self.lock_file, 'lock_file'):
                             #hierarchical key insertion
                             for subkey in hkey[ikey:-1]:
                                 partialkey = previouskey, subkey
-                                kstr, khash = process_key(partialkey)
+                                kstr, khash = self.process_key(partialkey)
                                 self.shelve.setitem(partialkey, None, kstr, khash)      #wite lock
                                 rowid = self.shelve.getrowid(partialkey, kstr, khash)   #read lock
                                 previouskey = Partial(rowid)
                             #insert leaf node
                             leafkey = previouskey, hkey[-1]
-                            kstr, khash = process_key(leafkey)
-                            self.shelve.setitem(leafkey, Deferred(), kstr, khash)       #write lock
+                            kstr, khash = self.process_key(leafkey)
+                            if self.shelve.locks_itself:
+                                #without a lock file, claims are made by compare and set
+                                if not self.shelve.claim(leafkey, Deferred(), kstr, khash):
+                                    metrics.count('claim_lost')
+                                    continue
+                            else:
+                                self.shelve.setitem(leafkey, Deferred(), kstr, khash)   #write lock
+                                #other processes need to see our claim once we release the lock
+                                self.shelve.commit().wait()
 
                         #dont need lock while doing expensive things
-                        value = self.operation(*args, **kwargs)
-
-                        with self.lock_file:
-                            self.shelve.setitem(leafkey, value     , kstr, khash)       #write lock
-                            return value
+                        try:
+                            started = time()
+                            with metrics.span('operation'):
+                                value = self.operation(*args, **kwargs)
+                            if trace is not None:
+                                trace.computed(tracekey, time() - started)
+                        except Exception:
+                            exc_info = sys.exc_info()
+                            self._fail(leafkey, kstr, khash, exc_info[1])
+                            raise exc_info[0], exc_info[1], exc_info[2]
+
+                        if self.write_behind:
+                            return self._write_behind(leafkey, kstr, khash, value)
+                        with metrics.timed(self.lock_file, 'lock_file'):
+                            return self._store(leafkey, kstr, khash, value)             #write lock
+
+            if validating is not None:
+                value, leafkey = validating
+                return self._validate(value, leafkey, args, kwargs, False)
+            metrics.count('failure')
+            failure.reraise()
+
+
+
+
+    def __reduce__(self):
+        """caches are pickled by identifier and constructor arguments, rather than by content"""
+        self.flush()
+        operation = self._init_args['operation']
+        name = getattr(operation, '__name__', None)
+        if name is not None:
+            wrapper = getattr(sys.modules.get(getattr(operation, '__module__', None)), name, None)
+            if getattr(wrapper, 'cache', None) is self:
+                #decorated; the module holds the wrapper by the name of the operation, so the operation does not pickle
+                return _restore_decorated, (operation.__module__, operation.__name__)
+        kwargs = dict(self._init_args)
+        kwargs['connect_clear'] = False     #the receiving end wants to use our entries, not wipe them
+        if kwargs['metrics'] not in (None, False, True):
+            kwargs['metrics'] = True        #metrics objects hold locks; start afresh
+        return _restore, (type(self), self.identifier, kwargs)
+
+    def _after_fork(self):
+        """
+        we are a forked child; threads did not come along, any locks held by them are held forever,
+        and lock files identify their owner by process id. the shelve takes care of its own connection
+        """
+        self.pid                = os.getpid()
+        self.lock               = threading.Lock()
+        self.lock_file          = self._lockfile()
+        self.pending            = {}        #the parent is responsible for its own pending values
+        self.pending_changed    = threading.Condition(threading.Lock())
+        self.writer             = None
+        self.validation_pool    = None
+        self.maintenance        = []        #the parent keeps maintaining
+        if self.metrics.enabled:
+            self.metrics.lock   = threading.Lock()
+
+    def _lockfile(self):
+        """the lock guarding the database against other processes; servers and shards bring their own"""
+        if self.shelve.locks_itself:
+            return NullLock()
+        return lockfile.MkdirLockFile(self.filename, timeout = self.lock_timeout)
+
+    def _wrap(self, value):
+        """timestamp a computed value if it is to expire"""
+        if isinstance(value, Expiring):
+            value.stamp = time()
+        elif self.ttl is not None:
+            value = Expiring(value, self.ttl)
+        return value
+
+    def _store(self, leafkey, kstr, khash, value):
+        """write a computed value to the leaf, and return the bare value"""
+        value = self._wrap(value)
+        self.shelve.setitem(leafkey, value, kstr, khash)
+        return value.value if isinstance(value, Expiring) else value
+
+    def _write_behind(self, leafkey, kstr, khash, value):
+        """hand a computed value to the background writer, and return the bare value"""
+        value = self._wrap(value)
+        with self.pending_changed:
+            #keystr is kept as the shelve encoded it; a wrapped mapping may not take a buffer for a key
+            self.pending[str(kstr)] = leafkey, kstr, khash, value
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._writer)
+                self.writer.daemon = True
+                self.writer.start()
+                _exiting.add(self)
+            self.pending_changed.notify_all()
+        self.metrics.count('write_behind')
+        return value.value if isinstance(value, Expiring) else value
+
+    def _writer(self):
+        """commit pending values in batches; values stay pending until they are on disk"""
+        #the lock file object identifies its owning thread; we need our own
+        lock_file = self._lockfile()
+        while True:
+            with self.pending_changed:
+                while not self.pending:
+                    if self.writer is None:
+                        return
+                    self.pending_changed.wait()
+                batch = self.pending.items()
+            items = [(leafkey, value, kstr, khash) for name, (leafkey, kstr, khash, value) in batch]
+            try:
+                with self.metrics.span('write_behind', size=len(items)), lock_file:
+                    self.shelve.setitems(items)
+            except Exception:
+                #retry one by one, such that a single bad value does not take the batch down with it
+                for item in items:
+                    self._write_one(lock_file, *item)
+            with self.pending_changed:
+                for kstr, item in batch:
+                    #a newer value may have been handed to us in the meantime
+                    if self.pending.get(kstr) is item:
+                        del self.pending[kstr]
+                self.pending_changed.notify_all()
+
+    def _write_one(self, lock_file, leafkey, value, kstr, khash):
+        try:
+            with lock_file:
+                self.shelve.setitem(leafkey, value, kstr, khash)
+            return
+        except Exception:
+            logger.exception('Writing behind to cache %s failed', self.identifier)
+        #release the deferred token; better to recompute than to wait for nothing
+        try:
+            with lock_file:
+                self.shelve.delitem(leafkey, kstr, khash)
+        except KeyError:
+            pass
+        except Exception:
+            logger.exception('Releasing deferred value of cache %s failed', self.identifier)
+
+    def _shutdown(self, timeout):
+        """
+        stop maintenance, and flush and terminate the writer; at exit, see _shutdown
+        waits are bounded by timeout, such that a dead worker thread does not hang the exit
+        """
+        for maintenance in self.maintenance:
+            #a maintenance thread killed at exit would leave the lock file behind
+            maintenance.stop()
+        if (self.grouped or self.writer is not None) and not self.flush(timeout):
+            logger.error('Cache %s did not commit all its values within %s seconds', self.identifier, timeout)
+        with self.pending_changed:
+            writer, self.writer = self.writer, None
+            self.pending_changed.notify_all()
+        if writer is not None:
+            writer.join(timeout)
+
+    def preload(self, limit=None):
+        """
+        load the entries of the current environment into memory, in sequential scans of the database,
+        such that looking them up costs a dict access rather than a query. limit restricts this to the
+        given number of the hottest calls recorded by the trace of this cache
+        values are kept in their encoded form, and decoded upon each hit, just as they are from the database
+
+        the memory layer mirrors the tree of partial keys in the database; partials maps a parent rowid
+        and encoded subkey to the rowid of the partial key, and values maps them to the encoded leaf value.
+        entries changed by other processes after preloading are not seen; this suits caches of deterministic
+        computations, whose values do not change but by a change of environment
+        """
+        if limit is not None and self.trace is None:
+            raise ValueError('Preloading the hottest calls of %s requires a trace' % self.identifier)
+        hot = None if limit is None else set(self.trace.hottest(limit))
+        empty = str(encode(None))
+
+        def rows():
+            for rowid, keystr, valuestr in self.shelve.iterraw():
+                key = decode_key(keystr)
+                if isinstance(key, tuple) and len(key) == 2 and isinstance(key[0], Partial):
+                    yield rowid, key[0].rowid, key[1], valuestr
+                #else an environment
+
+        with self.metrics.span('preload'):
+            partials = {}
+            paths = {self.envrowid: ()}     #rowid of each partial key of the current environment -> its path
+            if self.hierarchy:
+                #a first scan collects the partial keys, which are few and small; rows are not ordered by
+                #parent in every shelve, so the tree is only known once all of them have been seen
+                children = {}       #parent rowid -> [(subkey, rowid)]
+                for rowid, parent, subkey, valuestr in rows():
+                    #an operation returning None is indistinguishable from a partial key; so is it in the database
+                    if str(valuestr) == empty:
+                        children.setdefault(parent, []).append((subkey, rowid))
+                stack = [self.envrowid]
+                while stack:
+                    parent = stack.pop()
+                    for subkey, rowid in children.get(parent, ()):
+                        partials[parent, subkey] = rowid
+                        paths[rowid] = paths[parent] + (subkey,)
+                        stack.append(rowid)
+                del children
+            #keep only the values of the current environment, and of hot calls if so requested, as we go
+            #the partial keys are in partials already; their rows hold no value
+            values = {}
+            for rowid, parent, subkey, valuestr in rows():
+                if rowid in paths:
+                    continue
+                path = paths.get(parent)
+                if path is not None and (hot is None or canonical.digest(path + (subkey,)) in hot):
+                    values[parent, subkey] = str(valuestr)
+        self.memory = partials, values
+        self.metrics.count('preloaded_values', len(values))
+        return len(values)
+
+    def _recall(self, hkey):
+        """preloaded value of an encoded hierarchical key; raises KeyError if there is none"""
+        partials, values = self.memory
+        parent = self.envrowid
+        for subkey in hkey[:-1]:
+            parent = partials[parent, subkey]
+        value = decode(values[parent, hkey[-1]])
+        if isinstance(value, (Deferred, Failure, Expiring)):
+            #tokens are for the database path to resolve
+            values.pop((parent, hkey[-1]), None)
+            raise KeyError(hkey[-1])
+        return value
+
+    def compact(self):
+        """
+        rewrite the database without free space, enabling incremental vacuum on databases created without it
+        all other users of the cache are blocked for the duration; background maintenance is the gentler option
+        """
+        if self.server:
+            raise ValueError('Cache %s is served; its server owns the database' % self.identifier)
+        if not hasattr(self.shelve, 'compact'):
+            raise ValueError('Cache %s is not stored in a database of its own' % self.identifier)
+        self.flush()
+        if self.shelve.locks_itself:
+            self.shelve.compact().wait()
+        else:
+            with self.lock, self.lock_file:
+                self.shelve.compact().wait()
 
+    def flush(self, timeout=None):
+        """
+        block until all values written behind, or awaiting a group commit, are committed
+        returns False if they are not within timeout seconds
+        """
+        if self.pid != os.getpid():
+            self._after_fork()
+        deadline = None if timeout is None else time() + timeout
+        with self.pending_changed:
+            while self.pending:
+                if deadline is None:
+                    self.pending_changed.wait()
+                else:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        return False
+                    self.pending_changed.wait(remaining)
+        return self.shelve.durable().wait(None if deadline is None else max(0, deadline - time()))
+
+    def _fail(self, leafkey, kstr, khash, exception):
+        """
+        the operation raised; release our deferred token, so nobody waits for it any longer,
+        and replace it by a failure if this type of exception is to be cached
+        """
+        self.metrics.count('error')
+        for cls in type(exception).__mro__:
+            if cls in self.cache_exceptions:
+                failure = Failure(exception, self.cache_exceptions[cls])
+                break
+        else:
+            failure = None
+        try:
+            with self.lock_file:
+                if failure is None:
+                    self.shelve.delitem(leafkey, kstr, khash)
+                else:
+                    self.shelve.setitem(leafkey, failure, kstr, khash)
+        except Exception:
+            logger.exception('Failed to record failure in cache %s', self.identifier)
+
+    def _revalidate(self, leafkey, current, args, kwargs):
+        """
+        claim the refresh of an expired entry, by replacing it with a deferred token holding the stale value
+        if we succeed, the refresh is performed on a background thread
+        """
+        kstr, khash = self.process_key(leafkey)
+        stale = current.stale if isinstance(current, Deferred) else current
+        with self.lock_file:
+            #someone else may have beaten us to it
+            latest = self.shelve.getitem(leafkey, kstr, khash)
+            if type(latest) is not type(current) or latest.stamp != current.stamp:
+                return
+            if self.shelve.locks_itself:
+                if not self.shelve.claim(leafkey, Deferred(stale), kstr, khash):
+                    return
+            else:
+                self.shelve.setitem(leafkey, Deferred(stale), kstr, khash)
+                self.shelve.commit().wait()
+        self.metrics.count('revalidate')
+        thread = threading.Thread(target=self._refresh, args=(leafkey, kstr, khash, stale, args, kwargs))
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self, leafkey, kstr, khash, stale, args, kwargs):
+        try:
+            with self.metrics.span('operation'):
+                value = self.operation(*args, **kwargs)
+        except Exception:
+            logger.exception('Refreshing an entry of cache %s failed', self.identifier)
+            #put the stale value back; the next caller will try again
+            with self.lock, self.lock_file:
+                self.shelve.setitem(leafkey, stale, kstr, khash)
+            return
+        with self.lock, self.lock_file:
+            self._store(leafkey, kstr, khash, value)
 
+    def _validate(self, value, leafkey, args, kwargs, background):
+        """
+        check if recomputed value is identical under deterministic serialization
+        returns the value to be handed to the caller; the recomputed one if the cached one proves invalid
+        """
+        metrics = self.metrics
+        metrics.count('validated')
+        try:
+            with metrics.span('validate'):
+                newvalue = self.operation(*args, **kwargs)
+                #note; new may differ from old in case aliasing in an ndarray was erased
+                #by original serialization. is this an error?
+                #id say so; depending on wether we have a cache hit, downstream code may react diffently
+                #perhaps its best to use custom serializating for values too
+                if as_deterministic(value)==as_deterministic(newvalue):
+                    return value
+        except Exception:
+            logger.exception('Validation of cache %s failed', self.identifier)
+            return value
+
+        metrics.count('invalid')
+        self.on_invalid(self, args, kwargs, value, newvalue)
+        if self.quarantine:
+            if background:
+                with self.lock:
+                    self._quarantine(leafkey)
+            else:
+                self._quarantine(leafkey)
+        return newvalue
+
+    def _quarantine(self, leafkey):
+        """remove an invalid leaf from the cache, so that it will be recomputed upon its next retrieval"""
+        self.metrics.count('quarantined')
+        with self.lock_file:
+            try:
+                self.shelve.delitem(leafkey, *self.process_key(leafkey))
+            except KeyError:
+                pass
 
+    def stats(self):
+        """
+        snapshot of the statistics collected by this cache,
+        and the number of rows and bytes in its database
+        note that rows include the environment and partial keys
+        """
+        stats = self.metrics.snapshot()
+        stats['storage'] = self.shelve.stats()
+        return stats
 
     def operation(self, input):
         """
@@ -349,13 +1012,14 @@ def CacheDecorator(
             **kwargs)
         def inner(*args, **kwargs):
             return cache(*args, **kwargs)
+        functools.update_wrapper(inner, operation)
+        inner.cache = cache
         return inner
     return wrap
 #a simple alias
 cached = CacheDecorator
-#prebind some arguments relating to in-memory storage?
-#with in memory dict and non-deterministic cPickle serializer makes a good memoize
-memoize = CacheDecorator
+#in memory, with native or cPickle keys, memoization within a process takes a dict lookup
+from memory import MemoryCache, memoize
 
 
 
@@ -379,7 +1043,7 @@ if False:
     print compile('const {dtype} = {value};', dict(dtype='int',value=3))
     quit()
 
-if True:
+if False:
 
     @cached(connect_clear=True, validate=True)
     def foo(a,b):
@@ -455,8 +1119,8 @@ if __name__=='__main__':
     args = [('const {dtype} = {value};', dict(dtype='int',value=i)) for i in range(10)]
 
     #run multiple jobs concurrent as either processes or threads
-    threading=False
-    if threading:
+    use_threads=False
+    if use_threads:
         import multiprocessing.dummy as multiprocessing
     else:
         import multiprocessing
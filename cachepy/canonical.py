@@ -0,0 +1,295 @@
+
+"""
+canonical binary encoding of keys
+
+pickles depend on the pickle protocol, the interpreter version and the way objects
+happen to be constructed; and zlib output depends on the zlib build.
+keys stored in a long lived, shared cache should not depend on any of those,
+or an interpreter upgrade silently invalidates the whole cache
+
+this module defines a versioned, self-describing encoding, which depends only on the value of the key:
+    None, bools, ints (int and long alike), floats, bytes and unicode strings
+    tuples, lists, dicts, sets and frozensets thereof; dicts and sets are sorted on the encoding of their items
+    ndarrays, as dtype, shape and little endian data; structured dtypes by the description of their fields
+    user defined types registered with a name and a reduction to encodable objects
+    objects providing their own cache key, or implementing the merkle protocol of the serialization module
+
+the encoding is reversible; decode maps it back to an equal object
+
+anything else, as well as keys with cycles or repeated mutable containers (whose aliasing is semantically relevant),
+is wrapped in its entirety as the output of serialization.as_deterministic, which is not guaranteed to be
+stable across interpreter versions. registering your key types avoids this
+
+note that under python 2, str is encoded as bytes; a python 3 process will need to use bytes
+for its keys to find the same entries
+"""
+
+import struct
+import hashlib
+
+import numpy as np
+
+from serialization import as_deterministic, Digest, CacheKey, cache_key
+
+
+version = 1
+_header = 'CK' + chr(version)
+
+
+class _NotCanonical(Exception):
+    """raised upon encountering something that has no canonical encoding"""
+
+
+#registry of user defined types
+_types = {}     #type -> (name, reduce)
+_names = {}     #name -> rebuild
+
+def register(cls, name, reduce, rebuild=None):
+    """
+    register a user defined type for canonical encoding
+    name should be unique and stable across versions of your code; typically 'package.Class'
+    reduce maps an instance to an encodable object, which completely determines its value as a key
+    rebuild maps such an object back to an instance; if omitted, decoding returns the reduced object
+    """
+    if name in _names and _types.get(cls, (None,))[0] != name:
+        raise ValueError('A type named %s is already registered' % name)
+    _types[cls] = name, reduce
+    _names[name] = rebuild
+
+
+def _varint(n):
+    """unsigned LEB128"""
+    out = []
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(chr(b | 0x80))
+        else:
+            out.append(chr(b))
+            return ''.join(out)
+
+def _track(obj, seen):
+    i = id(obj)
+    if i in seen:
+        raise _NotCanonical()
+    seen.add(i)
+
+def _encode(obj, seen):
+    try:
+        encoder = _dispatch[type(obj)]
+    except KeyError:
+        try:
+            name, reduce = _types[type(obj)]
+        except KeyError:
+            key = cache_key(obj)
+            if key is None:
+                raise _NotCanonical()
+            return _encode(key, seen)
+        return 'R' + _bytes(name, seen) + _encode(reduce(obj), seen)
+    return encoder(obj, seen)
+
+def _none(obj, seen):
+    return 'N'
+def _bool(obj, seen):
+    return 'T' if obj else 'F'
+def _int(obj, seen):
+    return 'i' + _varint(2 * obj if obj >= 0 else -2 * obj - 1)     #zigzag encoding
+def _float(obj, seen):
+    return 'f' + struct.pack('<d', obj)
+def _bytes(obj, seen):
+    return 'b' + _varint(len(obj)) + obj
+def _unicode(obj, seen):
+    obj = obj.encode('utf-8')
+    return 'u' + _varint(len(obj)) + obj
+def _tuple(obj, seen):
+    return 't' + _varint(len(obj)) + ''.join([_encode(o, seen) for o in obj])
+def _list(obj, seen):
+    _track(obj, seen)
+    return 'l' + _varint(len(obj)) + ''.join([_encode(o, seen) for o in obj])
+def _dict(obj, seen):
+    _track(obj, seen)
+    items = sorted([(_encode(k, seen), _encode(v, seen)) for k, v in obj.iteritems()])
+    return 'd' + _varint(len(items)) + ''.join([k + v for k, v in items])
+def _set(obj, seen):
+    _track(obj, seen)
+    return 's' + _varint(len(obj)) + ''.join(sorted([_encode(o, seen) for o in obj]))
+def _frozenset(obj, seen):
+    return 'z' + _varint(len(obj)) + ''.join(sorted([_encode(o, seen) for o in obj]))
+def _ndarray(obj, seen):
+    if obj.dtype.hasobject:
+        raise _NotCanonical()
+    #arrays sharing memory within a key carry aliasing information, which only the deterministic pickler records
+    base = obj
+    while isinstance(base.base, np.ndarray):
+        base = base.base
+    _track(base, seen)
+    dtype = obj.dtype.newbyteorder('<') if obj.dtype.byteorder in '=>' else obj.dtype
+    data = np.ascontiguousarray(obj, dtype=dtype).tostring()
+    return 'a' + _dtype(dtype, seen) + _tuple(obj.shape, seen) + _bytes(data, seen)
+def _dtype(dtype, seen):
+    if dtype.fields is None:
+        return _bytes(dtype.str, seen)
+    #the str of a structured dtype is merely its size; two layouts of the same size would collide
+    try:
+        descr = dtype.descr
+    except ValueError:
+        #overlapping or out of order fields have no description
+        raise _NotCanonical()
+    return _description(descr, seen)
+def _description(obj, seen):
+    #the lists of a description are created on the fly; tracking them would mistake a reused id for aliasing
+    if isinstance(obj, list):
+        return 'l' + _varint(len(obj)) + ''.join([_description(o, seen) for o in obj])
+    if isinstance(obj, tuple):
+        return 't' + _varint(len(obj)) + ''.join([_description(o, seen) for o in obj])
+    return _encode(obj, seen)
+
+_dispatch = {
+    type(None)  : _none,
+    bool        : _bool,
+    int         : _int,
+    long        : _int,
+    float       : _float,
+    str         : _bytes,
+    unicode     : _unicode,
+    tuple       : _tuple,
+    list        : _list,
+    dict        : _dict,
+    set         : _set,
+    frozenset   : _frozenset,
+    np.ndarray  : _ndarray,
+    }
+
+
+register(Digest, 'cachepy.Digest', str, Digest)
+register(CacheKey, 'cachepy.CacheKey', tuple, CacheKey)
+
+
+def encode(obj):
+    """map a key object to its canonical byte string"""
+    try:
+        return _header + _encode(obj, set())
+    except _NotCanonical:
+        return _header + 'P' + _bytes(as_deterministic(obj), None)
+
+def digest(obj):
+    """stable sha256 digest of a key object"""
+    return hashlib.sha256(encode(obj)).digest()
+
+def hash64(keystr):
+    """signed 64 bit integer hash of an encoded key, suitable for an sqlite index"""
+    return struct.unpack('<q', hashlib.sha256(keystr).digest()[:8])[0]
+
+
+def _readvarint(s, i):
+    n = shift = 0
+    while True:
+        b = ord(s[i])
+        i += 1
+        n |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            return n, i
+
+def _decode(s, i):
+    tag = s[i]
+    i += 1
+    if tag == 'N': return None, i
+    if tag == 'T': return True, i
+    if tag == 'F': return False, i
+    if tag == 'i':
+        z, i = _readvarint(s, i)
+        return (z >> 1 if not z & 1 else -((z + 1) >> 1)), i
+    if tag == 'f':
+        return struct.unpack('<d', s[i:i+8])[0], i + 8
+    if tag in 'bu':
+        n, i = _readvarint(s, i)
+        value = s[i:i+n]
+        return (value if tag == 'b' else value.decode('utf-8')), i + n
+    if tag in 'tlsz':
+        n, i = _readvarint(s, i)
+        items = []
+        for j in xrange(n):
+            item, i = _decode(s, i)
+            items.append(item)
+        return {'t': tuple, 'l': list, 's': set, 'z': frozenset}[tag](items), i
+    if tag == 'd':
+        n, i = _readvarint(s, i)
+        items = []
+        for j in xrange(n):
+            k, i = _decode(s, i)
+            v, i = _decode(s, i)
+            items.append((k, v))
+        return dict(items), i
+    if tag == 'a':
+        dtype, i = _decode(s, i)
+        shape, i = _decode(s, i)
+        data, i = _decode(s, i)
+        return np.frombuffer(data, dtype=dtype).reshape(shape).copy(), i
+    if tag == 'R':
+        name, i = _decode(s, i)
+        reduced, i = _decode(s, i)
+        rebuild = _names.get(name)
+        return (rebuild(reduced) if rebuild else reduced), i
+    if tag == 'P':
+        #the deterministic representation is all we have
+        return _decode(s, i)
+    raise ValueError('Invalid canonical encoding')
+
+def decode(keystr):
+    """map a canonical byte string back to a key object"""
+    keystr = str(keystr)
+    if keystr[:2] != _header[:2]:
+        raise ValueError('Not a canonical encoding')
+    if ord(keystr[2]) != version:
+        raise ValueError('Unsupported canonical encoding version %i' % ord(keystr[2]))
+    obj, i = _decode(keystr, 3)
+    return obj
+
+
+
+if __name__=='__main__':
+    k1, k2 = {1: 0, 9: 0}, {9: 0, 1: 0}
+    assert encode(k1) == encode(k2)
+    assert encode(1) == encode(1L)
+    assert encode(1) != encode(1.0) != encode(True)
+
+    class Point(object):
+        def __init__(self, x, y):
+            self.x, self.y = x, y
+    register(Point, 'demo.Point', lambda p: (p.x, p.y), lambda t: Point(*t))
+
+    key = (None, -12345678901234567890, 3.5, 'abc', u'\u20ac', [1, (2,)], {'a': {1, 2}}, frozenset([3]),
+           np.arange(6, dtype='>i4').reshape(2, 3), Point(1, 2))
+    keystr = encode(key)
+    print len(keystr), digest(key).encode('hex'), hash64(keystr)
+    back = decode(keystr)
+    assert encode(back) == keystr
+    assert back[:8] == key[:8]
+
+    #structured arrays are told apart by their fields, not just their size
+    a = np.zeros(2, dtype=[('x', '<i4'), ('y', '<f8')])
+    b = np.zeros(2, dtype=[('y', '<f8'), ('x', '<i4')])
+    assert encode(a) != encode(b) and encode((a, a.copy()))[3] == 't'
+    assert decode(encode(a)).dtype == a.dtype and decode(encode(b)).dtype == b.dtype
+    c = np.zeros(2, dtype=[('s', [('p', '>i2', (2,))]), ('q', 'S3')])
+    assert decode(encode(c)).dtype == c.dtype
+    assert encode(np.zeros(2, dtype={'names': ['x', 'y'], 'formats': ['<i4', '<i4'], 'offsets': [4, 0]}))[3] == 'P'
+
+    #aliasing within the key falls back to the deterministic pickler
+    a = np.arange(4)
+    assert encode((a[1:], a))[3] == 'P'
+    #as do unregistered types
+    class Other(object):
+        pass
+    assert encode(Other())[3] == 'P'
+    #merkle nodes are keyed as their digest
+    from serialization import Node, merkle_digest, register_cache_key
+    node = Node('+', Node(1), Node(2))
+    assert encode(node) == encode(merkle_digest(node)) == encode(Digest(merkle_digest(node)))
+    #as are objects providing their own cache key
+    register_cache_key(Other, lambda o: 'other-v1')
+    assert encode(Other()) == encode(Other())
+    assert decode(encode(Other())) == ('__main__.Other', 'other-v1')
+    print 'all tests passed'
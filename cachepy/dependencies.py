@@ -0,0 +1,218 @@
+
+"""
+automatic discovery of the dependencies of a cached operation
+
+the source of the operation itself is part of the environment of a cache by default
+but edits to the helper functions it calls, or to module level constants it uses, go unnoticed;
+and including more than that by hand tends to result in overly broad environments,
+which invalidate the cache more often than necessary
+
+this module follows the globals, closures and attribute accesses of a function,
+to the functions, classes and constants it refers to, within a chosen set of packages
+everything outside of those packages is considered part of the explicit environment,
+such as a compiler version; we do not want to recurse into numpy
+
+the sources of the objects found are hashed into a fingerprint
+source digests are cached per module, and recomputed only when the mtime of the module changes
+
+note that this is a static analysis of names; dynamic lookups such as getattr(module, name)
+are invisible to it. it errs on the side of including too much rather than too little;
+any attribute name used in the code is looked up on referenced modules
+"""
+
+import os
+import sys
+import types
+import inspect
+import hashlib
+
+import canonical
+from serialization import Digest
+
+
+#(filename, mtime) -> {(module, name, firstline): digest}
+_source_cache = {}
+
+def _source_digest(obj):
+    """digest of the source of a function or class, cached per module by mtime"""
+    try:
+        filename = inspect.getsourcefile(obj)
+        mtime = os.path.getmtime(filename)
+    except (TypeError, OSError):
+        filename = mtime = None
+    code = getattr(obj, '__code__', None)
+    module, name = _module_of(obj), getattr(obj, '__name__', None)
+    ident = module, name, code.co_firstlineno if code else None
+    if code is None and getattr(sys.modules.get(module), name, None) is not obj:
+        #a class defined within a function; others of the same name may be defined in the same module
+        filename = None
+    cache = None
+    if filename:
+        cache = _source_cache.get((filename, mtime))
+        if cache is None:
+            #drop digests belonging to previous versions of this module
+            for key in [k for k in _source_cache if k[0] == filename]:
+                del _source_cache[key]
+            cache = _source_cache[(filename, mtime)] = {}
+        try:
+            return cache[ident]
+        except KeyError:
+            pass
+    try:
+        source = inspect.getsource(obj)
+    except (IOError, TypeError):
+        #no source available, for instance for functions defined interactively; use the bytecode instead
+        if code is None:
+            raise
+        source = code.co_code + repr(code.co_consts) + repr(code.co_names)
+    digest = hashlib.sha256(source).digest()
+    if cache is not None:
+        cache[ident] = digest
+    return digest
+
+
+def _module_of(obj):
+    if isinstance(obj, types.ModuleType):
+        return obj.__name__
+    return getattr(obj, '__module__', None)
+
+def _tracked(name, packages):
+    return name is not None and any(name == p or name.startswith(p + '.') for p in packages)
+
+def _qualname(obj):
+    return '%s.%s' % (_module_of(obj), getattr(obj, '__name__', '?'))
+
+def _codes(code):
+    """a code object, and all code objects nested in it, such as those of lambdas and inner functions"""
+    yield code
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            for c in _codes(const):
+                yield c
+
+def _constant(obj):
+    """canonical encoding of a constant, or None if obj is not one"""
+    if type(obj) not in canonical._dispatch:
+        return None
+    encoded = canonical.encode(obj)
+    if encoded[3] == 'P':
+        return None     #not a plain value; ignore objects we cannot describe by value
+    return encoded
+
+
+def dependencies(func, packages=None):
+    """
+    sorted list of (name, digest) of all functions, classes and constants func depends upon,
+    within the given packages. packages defaults to the top level package of func
+    """
+    if isinstance(func, types.MethodType):
+        func = func.__func__
+    if packages is None:
+        packages = [func.__module__.split('.')[0]]
+
+    found = {}
+    visited = set()
+    stack = [func]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in visited:
+            continue
+        visited.add(id(obj))
+
+        if isinstance(obj, types.MethodType):
+            stack.append(obj.__func__)
+            continue
+        if isinstance(obj, (type, types.ClassType)):
+            found[_qualname(obj)] = _source_digest(obj)
+            stack.extend(v for v in vars(obj).values()
+                         if isinstance(v, (types.FunctionType, staticmethod, classmethod)))
+            continue
+        if isinstance(obj, (staticmethod, classmethod)):
+            stack.append(obj.__func__)
+            continue
+        if not isinstance(obj, types.FunctionType):
+            continue
+
+        digest = _source_digest(obj)
+        qualname = _qualname(obj)
+        if obj.__name__ == '<lambda>':
+            qualname += ':' + digest.encode('hex')[:16]
+        found[qualname] = digest
+        names = set()
+        for code in _codes(obj.__code__):
+            names.update(code.co_names)
+        #(name under which a constant is recorded, referenced object)
+        referenced = [('%s.%s' % (obj.__module__, name), obj.__globals__[name]) for name in names if name in obj.__globals__]
+        for name, cell in zip(obj.__code__.co_freevars, obj.__closure__ or ()):
+            try:
+                value = cell.cell_contents
+            except ValueError:
+                continue        #an empty cell; a variable of the enclosing function not assigned yet
+            referenced.append(('%s.<locals>.%s' % (qualname, name), value))
+        modules = set()
+        for key, value in referenced:
+            if isinstance(value, types.ModuleType):
+                if _tracked(value.__name__, packages) and value.__name__ not in modules:
+                    #attribute access on a tracked module; follow any name that resolves, constants included
+                    modules.add(value.__name__)
+                    attributes = vars(value)
+                    referenced.extend(('%s.%s' % (value.__name__, n), attributes[n]) for n in names if n in attributes)
+                continue
+            if isinstance(value, (types.FunctionType, types.MethodType, type, types.ClassType)):
+                if _tracked(_module_of(value), packages):
+                    stack.append(value)
+                continue
+            if _tracked(obj.__module__, packages):
+                encoded = _constant(value)
+                if encoded is not None:
+                    found[key] = hashlib.sha256(encoded).digest()
+    return sorted(found.items())
+
+
+def fingerprint(func, packages=None):
+    """single digest describing func and all its dependencies within packages"""
+    h = hashlib.sha256()
+    for name, digest in dependencies(func, packages):
+        h.update(name)
+        h.update('\x00')
+        h.update(digest)
+    return Digest(h.digest())
+
+
+
+scale = 3
+
+def _helper(x):
+    return x * scale
+
+def _operation(x):
+    return _helper(x) + sys.maxint
+
+#stands in for a module of settings within the package
+config = types.ModuleType(__name__ + '.config')
+config.SCALE = 2
+
+def _configured(x):
+    return x * config.SCALE
+
+def _closure(scale):
+    def inner(x):
+        return x * scale
+    return inner
+
+if __name__=='__main__':
+    for name, digest in dependencies(_operation):
+        print name, digest.encode('hex')[:16]
+    before = fingerprint(_operation)
+    scale = 4
+    assert fingerprint(_operation) != before
+
+    #constants read through a tracked module
+    before = fingerprint(_configured)
+    config.SCALE = 3
+    assert fingerprint(_configured) != before
+
+    #closure constants are told apart from globals of the same name
+    print [name for name, digest in dependencies(_closure(4))]
+    assert fingerprint(_closure(4)) != fingerprint(_closure(5))
+    print 'all tests passed'
@@ -30,3 +30,22 @@ https://bitbucket.org/pchambon/python-rock-solid-tools/src/74e361d85015?at=defau
 """
 
 import lockfile.mkdirlockfile as LockFile
+
+
+class NullLock(object):
+    """
+    stands in for a lock file where none is needed,
+    such as for a cache server, which serializes requests itself
+    """
+    def __init__(self, *args, **kwargs):
+        pass
+    def __enter__(self):
+        return self
+    def __exit__(self, type, value, traceback):
+        pass
+    def acquire(self, timeout=None):
+        pass
+    def release(self):
+        pass
+    def is_locked(self):
+        return False
@@ -0,0 +1,206 @@
+
+"""
+online maintenance of cache databases
+
+deletes and replacements leave free pages behind, which sqlite reuses but never returns to the filesystem;
+and clear deliberately avoids VACUUM. so a long lived cache file only ever grows, and its rows scatter over it.
+a full VACUUM rewrites the file, but blocks all writers for as long as that takes
+
+shelves create their databases with incremental auto vacuum, which lets free pages be returned a few at a time;
+compact rewrites a database once to enable it on files created without. a Maintenance thread then periodically
+    returns free pages to the filesystem, in small steps with pauses in between
+    runs ANALYZE once the number of rows has changed substantially, so the query planner keeps up
+    runs an integrity check, and logs any problems found, at a longer interval
+    deletes deduplicated values no longer referred to, which were not deleted right away
+
+each step takes the lock file of the database without waiting for it; if a cache holds it,
+maintenance backs off and tries again later, rather than queueing up in front of the cache.
+a cache waits for maintenance for at most a single step. the integrity check, which reads the whole
+database, is no such step; it reads on a connection of its own, without taking the lock file
+
+to compact cache files by hand; processes using them wait for it to finish:
+    python maintenance.py compact /tmp/cachepy/mycache
+"""
+
+import logging
+from threading import Thread, Event, Timer
+from time import time, sleep
+
+import lockfile.mkdirlockfile as lockfile
+
+from metrics import select_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Busy(Exception):
+    """the lock file stayed taken for all attempts of a maintenance step"""
+
+
+class Maintenance(Thread):
+    """background thread maintaining a shelve"""
+
+    def __init__(
+            self,
+            shelve,
+            interval            = 600,      #seconds between rounds of maintenance
+            pages               = 64,       #free pages returned to the filesystem per step
+            pause               = 0.05,     #seconds between steps; also the initial backoff when the lock file is taken
+            attempts            = 8,        #number of times a step backs off, doubling the pause, before skipping the round
+            analyze             = 0.2,      #relative change in the number of rows which triggers an ANALYZE
+            check               = 86400,    #seconds between integrity checks. None disables them
+            metrics             = None,
+            ):
+        super(Maintenance, self).__init__()
+        self.shelve             = shelve
+        self.interval           = interval
+        self.pages              = pages
+        self.pause              = pause
+        self.attempts           = attempts
+        self.analyze            = analyze
+        self.check              = check
+        self.metrics            = select_metrics(metrics, shelve.filename)
+        self.analyzed           = None      #number of rows at the last ANALYZE
+        self.checked            = time()    #time of the last integrity check
+        self.stopped            = False
+        self.wakeup             = Event()
+        self.daemon             = True
+        self.start()
+
+    def run(self):
+        #the lock file identifies its owner by thread, so this thread needs its own
+        self.lock_file = lockfile.MkdirLockFile(self.shelve.filename, timeout = 0)
+        while True:
+            #timed waits poll under python 2
+            timer = Timer(self.interval, self.wakeup.set)
+            timer.daemon = True
+            timer.start()
+            self.wakeup.wait()
+            timer.cancel()
+            timer.join()        #rather than leaving it behind at exit
+            self.wakeup.clear()
+            if self.stopped:
+                return
+            try:
+                self.maintain()
+            except Busy:
+                self.metrics.count('maintenance_skipped')
+                logger.debug('%s is busy; skipping maintenance', self.shelve.filename)
+            except Exception:
+                logger.exception('Maintenance of %s failed', self.shelve.filename)
+
+    def stop(self, timeout=5):
+        """stop after the current step, if any"""
+        self.stopped = True
+        self.wakeup.set()
+        self.join(timeout)
+
+    def _step(self, func, *args):
+        """run func under the lock file, backing off while someone else holds it"""
+        pause = self.pause
+        for attempt in range(self.attempts):
+            if self.stopped:
+                raise Busy()
+            try:
+                self.lock_file.acquire()
+            except lockfile.AlreadyLocked:
+                self.metrics.count('maintenance_busy')
+                sleep(pause)
+                pause *= 2
+                continue
+            try:
+                return func(*args)
+            finally:
+                self.lock_file.release()
+        raise Busy()
+
+    def maintain(self):
+        """a single round of maintenance; returns the number of pages freed"""
+        freed = 0
+        collected = self._step(self.shelve.collect)
+        self.metrics.count('blobs_collected', collected)
+        space = self.shelve.space()
+        if space['free_pages'] and not space['incremental']:
+            logger.warning('%s has %i free pages, but was created without incremental vacuum; compact it',
+                           self.shelve.filename, space['free_pages'])
+        elif space['free_pages']:
+            with self.metrics.span('vacuum'):
+                while space['free_pages'] and not self.stopped:
+                    self._step(self.shelve.vacuum, self.pages)
+                    #the group commit window of the shelve may delay the effect of a step
+                    self.shelve.commit().wait()
+                    remaining = self.shelve.space()['free_pages']
+                    if remaining >= space['free_pages']:
+                        break
+                    freed += space['free_pages'] - remaining
+                    space['free_pages'] = remaining
+                    sleep(self.pause)
+            self.metrics.count('pages_freed', freed)
+
+        rows = self.shelve.stats()['rows']
+        if self.analyzed is None or abs(rows - self.analyzed) > self.analyze * max(self.analyzed, 1):
+            with self.metrics.span('analyze'):
+                self._step(self.shelve.analyze)
+            self.analyzed = rows
+
+        if self.check is not None and time() - self.checked > self.check:
+            with self.metrics.span('integrity_check'):
+                #only reads; cache lookups proceed meanwhile
+                problems = self.shelve.check()
+            self.checked = time()
+            if problems != ['ok']:
+                self.metrics.count('integrity_failed')
+                logger.error('Integrity check of %s failed: %s', self.shelve.filename, '; '.join(problems))
+        return freed
+
+
+def compact(filename, lock_timeout=60):
+    """rewrite a shelve database file without free pages, under its lock file"""
+    from shelve2 import Shelve
+    shelve = Shelve(filename, autocommit = True)
+    try:
+        before = shelve.stats()['file_bytes']
+        with lockfile.MkdirLockFile(filename, timeout = lock_timeout):
+            shelve.compact().wait()
+        return before, shelve.stats()['file_bytes']
+    finally:
+        shelve.close()
+
+
+
+if __name__=='__main__':
+    import os
+    import sys
+    import tempfile
+    args = sys.argv[1:]
+    if args and args[0] == 'compact':
+        for filename in args[1:]:
+            before, after = compact(filename)
+            print '%s: %i -> %i bytes' % (filename, before, after)
+    else:
+        from shelve2 import Shelve
+        filename = os.path.join(tempfile.gettempdir(), 'cachepy_maintenance_demo')
+        if os.path.exists(filename):
+            os.remove(filename)
+        shelve = Shelve(filename, autocommit = True, commit_window = 0.01)
+        for i in range(2000):
+            shelve[i] = os.urandom(1000)
+        shelve.commit().wait()
+        for i in range(1500):
+            del shelve[i]
+        shelve.commit().wait()
+        print 'before', shelve.stats()
+        full = shelve.stats()['file_bytes']
+
+        maintenance = Maintenance(shelve, interval = 0.1, check = 0, metrics = True)
+        #a cache holding the lock only delays maintenance
+        with lockfile.MkdirLockFile(filename):
+            sleep(0.3)
+        sleep(1)
+        maintenance.stop()
+        stats = shelve.stats()
+        print 'after', stats
+        print maintenance.metrics.snapshot()['counters']
+        assert stats['free_bytes'] == 0 and stats['file_bytes'] < full / 2
+        assert len(shelve) == 500
+        print 'all tests passed'
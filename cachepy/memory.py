@@ -0,0 +1,194 @@
+
+"""
+in-memory caching of function calls, for memoization within a process
+
+AbstractCache is built for long lived caches of expensive computations, shared between processes;
+every lookup encodes its key canonically, takes a thread lock and a lock file, and queries sqlite.
+none of that is of use to memoize a function within a single process, and all of it costs time;
+a MemoryCache hit is a single dict lookup
+
+keys are either
+    'native'    the arguments themselves, hashed by python. this is the fastest, but note that
+                equal arguments share an entry, whatever their type; f(1), f(1.0) and f(True) are the same call.
+                calls with unhashable arguments fall back to pickle keys
+    'pickle'    the pickled arguments. pickles of equal objects may differ, for instance of dicts
+                built in a different order; which only costs a redundant computation, never a wrong value
+
+the number of entries is bounded, by keeping two generations of them; once the young generation
+is full, the old one is dropped, and the young one becomes old. hits on the old generation promote
+the entry to the young one. this approximates least recently used eviction, without any bookkeeping
+on the hits of recently used entries
+
+concurrent calls with the same arguments compute them once; the others wait for the result.
+should the computation raise, the exception propagates to its caller only, and the next waiter
+in line tries again
+"""
+
+import threading
+import functools
+import types
+import cPickle as pickle
+
+
+_kwargs = object()      #marks keys of calls with keyword arguments
+
+
+class MemoryCache(object):
+    """
+    memoizes a function in memory; either pass the operation, or subclass and implement it
+    """
+    def __init__(
+            self,
+            operation           = None,     #function to be cached
+            maxsize             = 2**16,    #maximum number of entries
+            keys                = 'native', #'native' or 'pickle'; see above
+            ):
+        if operation: self.operation = operation
+        if keys not in ('native', 'pickle'):
+            raise ValueError('keys should be native or pickle, not %r' % keys)
+        self.maxsize            = maxsize
+        self.keys               = keys
+        self.young              = {}
+        self.old                = {}
+        self.lock               = threading.Lock()
+        self.inflight           = {}        #key -> event set once the call computing it is done
+        self.misses             = 0
+        self.evictions          = 0
+
+    def __call__(self, *args, **kwargs):
+        #pickle keys are strings, and never equal to these tuples; they end up in the slow path as well
+        #as do unhashable arguments, be it upon building the key or looking it up
+        try:
+            return self.young[(_kwargs, args, frozenset(kwargs.iteritems())) if kwargs else args]
+        except (KeyError, TypeError):
+            return self._miss(args, kwargs)
+
+    def __get__(self, instance, owner):
+        #memoize methods too; the instance is part of the key
+        if instance is None:
+            return self
+        return types.MethodType(self, instance)
+
+    def key(self, args, kwargs):
+        if self.keys == 'native':
+            try:
+                key = (_kwargs, args, frozenset(kwargs.iteritems())) if kwargs else args
+                hash(key)
+                return key
+            except TypeError:
+                pass
+        return pickle.dumps((args, sorted(kwargs.iteritems())), -1)
+
+    def _miss(self, args, kwargs):
+        key = self.key(args, kwargs)
+        while True:
+            with self.lock:
+                try:
+                    return self.young[key]
+                except KeyError:
+                    pass
+                try:
+                    value = self.old.pop(key)
+                except KeyError:
+                    pass
+                else:
+                    self._insert(key, value)
+                    return value
+                event = self.inflight.get(key)
+                if event is None:
+                    #we compute it
+                    event = self.inflight[key] = threading.Event()
+                    break
+            event.wait()
+
+        try:
+            value = self.operation(*args, **kwargs)
+        except:
+            with self.lock:
+                del self.inflight[key]
+            event.set()
+            raise
+        with self.lock:
+            self.misses += 1
+            self._insert(key, value)
+            del self.inflight[key]
+        event.set()
+        return value
+
+    def _insert(self, key, value):
+        if len(self.young) >= max(1, self.maxsize // 2):
+            self.evictions += len(self.old)
+            self.old, self.young = self.young, {}
+        self.young[key] = value
+
+    def operation(self, *args, **kwargs):
+        """implements the cached operation; to be invoked upon a cache miss"""
+        raise NotImplementedError()
+
+    def __len__(self):
+        return len(self.young) + len(self.old)
+
+    def clear(self):
+        with self.lock:
+            self.young, self.old = {}, {}
+
+    def stats(self):
+        return dict(size=len(self), maxsize=self.maxsize, misses=self.misses, evictions=self.evictions)
+
+
+def memoize(operation=None, maxsize=2**16, keys='native'):
+    """
+    decorator memoizing a function or method in memory; usable with or without arguments
+        @memoize
+        @memoize(maxsize=100)
+    """
+    def wrap(operation):
+        cache = MemoryCache(operation, maxsize, keys)
+        functools.update_wrapper(cache, operation)
+        return cache
+    if operation is not None:
+        return wrap(operation)
+    return wrap
+
+
+
+if __name__=='__main__':
+    from time import time, sleep
+    import multiprocessing.dummy
+
+    @memoize
+    def add(a, b=0):
+        return a + b
+    assert add(1, b=2) == add(1, b=2) == 3 and add.misses == 1
+    assert add([1], [2]) == [1, 2] and add([1], [2]) == [1, 2] and add.misses == 2     #unhashable; pickled keys
+    assert add([1], b=[2]) == [1, 2] and add([1], b=[2]) == [1, 2] and add.misses == 3  #also as keyword argument
+    n = 10**6
+    start = time()
+    for i in xrange(n):
+        add(1, 2)
+    print 'seconds per hit', (time() - start) / n
+
+    #concurrent calls with the same arguments are computed once
+    @memoize(maxsize=4)
+    def slow(x):
+        sleep(0.1)
+        return x
+    pool = multiprocessing.dummy.Pool(8)
+    assert pool.map(slow, [1] * 8 + [2] * 8) == [1] * 8 + [2] * 8
+    assert slow.misses == 2
+
+    #and the size is bounded
+    for i in range(10):
+        slow(i / 10.)
+    assert len(slow) <= 4 and slow(0.9) == 0.9 and slow.misses == 12
+    print slow.stats()
+
+    class Point(object):
+        def __init__(self, x):
+            self.x = x
+        @memoize
+        def norm(self):
+            return abs(self.x)
+    p = Point(-3)
+    assert p.norm() == p.norm() == 3 and Point.norm.misses == 1
+    print 'all tests passed'
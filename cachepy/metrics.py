@@ -0,0 +1,219 @@
+
+"""
+instrumentation of caches
+
+when a cache is slow, we want to know where the time goes;
+waiting on locks, polling deferred values, serialization, sqlite, or the operation itself
+
+a Metrics object collects counters and latency histograms, and forwards timed spans
+to any number of pluggable hooks, which may export them to a tracing system of choice
+a snapshot of all statistics can be taken at any time as a plain dict
+
+when instrumentation is disabled, the NullMetrics singleton is used instead;
+all its methods are no-ops, so the overhead is limited to a method call
+"""
+
+import math
+import logging
+import threading
+from time import time
+
+
+class Histogram(object):
+    """
+    latency histogram with logarithmic buckets
+    bucket i counts observations of at most 2**i microseconds
+    """
+    __slots__ = ['count', 'total', 'min', 'max', 'buckets']
+
+    def __init__(self):
+        self.count      = 0
+        self.total      = 0.0
+        self.min        = None
+        self.max        = None
+        self.buckets    = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min: self.min = value
+        if self.max is None or value > self.max: self.max = value
+        micro = value * 1e6
+        bucket = int(math.ceil(math.log(micro, 2))) if micro > 1 else 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def quantile(self, q):
+        """upper bound on the q-th quantile, as resolved by the bucketing"""
+        target = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return 2 ** bucket / 1e6
+        return self.max
+
+    def snapshot(self):
+        return dict(
+            count   = self.count,
+            total   = self.total,
+            mean    = self.total / self.count if self.count else None,
+            min     = self.min,
+            max     = self.max,
+            p50     = self.quantile(0.5),
+            p99     = self.quantile(0.99),
+            buckets = dict(self.buckets))
+
+
+class _Span(object):
+    """context manager timing a block of code"""
+    __slots__ = ['metrics', 'name', 'attrs', 'start']
+    def __init__(self, metrics, name, attrs):
+        self.metrics    = metrics
+        self.name       = name
+        self.attrs      = attrs
+    def __enter__(self):
+        self.start = time()
+        return self
+    def __exit__(self, type, value, traceback):
+        if type is not None:
+            self.attrs['error'] = repr(value)
+        self.metrics.record(self.name, self.start, time() - self.start, self.attrs)
+
+
+class TimedLock(object):
+    """wrap a lock, such that the time spent acquiring it is recorded"""
+    def __init__(self, lock, metrics, name):
+        self.lock       = lock
+        self.metrics    = metrics
+        self.name       = name
+    def __enter__(self):
+        start = time()
+        self.lock.__enter__()
+        self.metrics.record(self.name, start, time() - start, {})
+        return self
+    def __exit__(self, type, value, traceback):
+        return self.lock.__exit__(type, value, traceback)
+    def __getattr__(self, attr):
+        return getattr(self.lock, attr)
+
+
+class Metrics(object):
+    """
+    thread safe collection of counters and latency histograms of a single cache
+    hooks are callables with signature hook(name, start, duration, attrs),
+    invoked upon completion of every span
+    """
+    enabled = True
+
+    def __init__(self, name=None, hooks=()):
+        self.name       = name
+        self.hooks      = list(hooks)
+        self.lock       = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters   = {}
+            self.histograms = {}
+            self.started    = time()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        with self.lock:
+            try:
+                histogram = self.histograms[name]
+            except KeyError:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def record(self, name, start, duration, attrs):
+        """register a completed span"""
+        self.observe(name, duration)
+        for hook in self.hooks:
+            hook(name, start, duration, attrs)
+
+    def span(self, name, **attrs):
+        return _Span(self, name, attrs)
+
+    def timed(self, lock, name):
+        return TimedLock(lock, self, name)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(
+                name        = self.name,
+                uptime      = time() - self.started,
+                counters    = dict(self.counters),
+                histograms  = {k: v.snapshot() for k, v in self.histograms.items()})
+
+
+class _NullSpan(object):
+    __slots__ = []
+    def __enter__(self):
+        return self
+    def __exit__(self, type, value, traceback):
+        pass
+
+class NullMetrics(object):
+    """drop-in replacement for Metrics which does nothing at all"""
+    enabled = False
+    name    = None
+    _span   = _NullSpan()
+
+    def reset(self):
+        pass
+    def add_hook(self, hook):
+        raise ValueError('Instrumentation is disabled for this cache')
+    def count(self, name, n=1):
+        pass
+    def observe(self, name, seconds):
+        pass
+    def record(self, name, start, duration, attrs):
+        pass
+    def span(self, name, **attrs):
+        return self._span
+    def timed(self, lock, name):
+        return lock
+    def snapshot(self):
+        return dict(name=None, counters={}, histograms={})
+
+null_metrics = NullMetrics()
+
+
+def select_metrics(metrics, name=None):
+    """
+    map the metrics argument of a cache to a metrics object
+    False or None disables instrumentation, True creates a fresh Metrics object
+    """
+    if metrics is None or metrics is False:
+        return null_metrics
+    if metrics is True:
+        return Metrics(name)
+    return metrics
+
+
+def logging_hook(logger=logging.getLogger('cachepy'), level=logging.DEBUG):
+    """create a hook which writes all spans to a logger"""
+    def hook(name, start, duration, attrs):
+        logger.log(level, '%s took %.6fs %s', name, duration, attrs if attrs else '')
+    return hook
+
+
+
+if __name__=='__main__':
+    from time import sleep
+    logging.basicConfig()
+    metrics = Metrics('demo', hooks=[logging_hook(level=logging.WARNING)])
+    for i in range(10):
+        with metrics.span('sleep', i=i):
+            sleep(0.001 * i)
+        metrics.count('iterations')
+    print metrics.snapshot()
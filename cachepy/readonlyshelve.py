@@ -3,6 +3,7 @@ read only pycc type cache
 it is built once from a list of key value pairs, and cannot be appended to later
 keys are not stored in the database; only their hashes
 hash colisions are checked for at creation-time
+hashes are digests of the canonical key encoding, so they survive interpreter upgrades
 
 we could store keys with offsets into the binary file to load values lazily,
 but given that we typically use pretty much all functions in a pycc shelve
@@ -14,9 +15,7 @@ intended to be managed from within a Cache object, which defines its interaction
 """
 
 import cPickle as Pickle
-import numpy as np
-import hashlib
-from serialization import as_deterministic
+import canonical
 import gzip     #global zip of our cache may be worthwhile
 import util
 
@@ -24,7 +23,7 @@ import util
 def pickling(obj):
     return Pickle.dumps(obj, protocol=util.pickle_protocol)
 def hashing(obj):
-    return hashlib.sha256(pickling(as_deterministic(obj))).digest()
+    return canonical.digest(obj)
 
 class ReadOnlyShelve(object):
     """
@@ -49,9 +48,10 @@ class ReadOnlyShelve(object):
         """
         keys, values = zip(*items)
 
-        hashes = np.array( [hashing (key)   for key   in keys])
-        values = np.array( [pickling(value) for value in values])
-        assert np.unique(hashes).size == hashes.size, \
+        #note; no numpy string arrays here, they strip trailing null bytes
+        hashes = [hashing (key)   for key   in keys]
+        values = [pickling(value) for value in values]
+        assert len(set(hashes)) == len(hashes), \
             'Holy shit, 256 bit hash collision! Make some superficial changes to your code to make this go away!'
         Pickle.dump(
             dict(zip(hashes, values)),
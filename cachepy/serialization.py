@@ -8,9 +8,27 @@ using as_deterministic instead of dumps, we are good
 
 code adapted from joblib, as indicated below
 
-one weakness i have found so far is that numpy array view relationships are flattend
-in the pickling process. not likely to be an immediate issue, but good to be aware of
-i couldnt guarantee that there arnt any other gotchas like that
+reference equality is respected; cycles and shared sub-objects are handled through the pickle memo,
+which emits back-references to objects seen before. to keep this deterministic,
+equal strings are memoized by value rather than by identity,
+and objects pickled through a stand-in (sets, ndarrays) map to the same stand-in upon every occurrence.
+numpy views are recorded as an offset into the array owning their memory,
+so views on the same memory share a single copy of it in the output
+i couldnt guarantee that there arnt any other gotchas
+
+large graphs, such as expression graphs, may implement the merkle protocol instead;
+a node defines __merkle__, returning its local content and its children,
+and is keyed by a digest of its content and the digests of its children.
+digests are cached on the nodes, so that rekeying a graph after an edit
+only touches the nodes which have changed
+
+objects which already know a cheap and stable identity, such as a content hash or version id,
+may provide it through a __cache_key__ method, or through register_cache_key for types you cannot modify.
+serialization stops at such objects, and uses their cache key in their place
+
+the pure python pickler is slow though; keys which consist solely of flat types
+and builtin containers thereof take a fast path instead, which writes a compact
+length-prefixed encoding directly. only keys containing other objects are pickled
 
 
 """
@@ -62,6 +80,34 @@ class DeterministicPickler(Pickler):
     def __init__(self):
         self.stream = io.BytesIO()
         Pickler.__init__(self, self.stream, protocol=util.pickle_protocol)
+        self.standins   = {}    #id of original -> (original, stand-in)
+        self.values     = {}    #(type, string) -> memo index
+
+    def standin(self, obj, factory):
+        """
+        objects pickled by means of a stand-in object should map to the same stand-in
+        upon every occurence, or the memo will not recognize them
+        the original is kept alive, so its id cannot be recycled
+        """
+        try:
+            return self.standins[id(obj)][1]
+        except KeyError:
+            standin = factory(obj)
+            self.standins[id(obj)] = obj, standin
+            return standin
+
+    def save_string(self, obj, pack=struct.pack):
+        """
+        memoize strings by value rather than by identity;
+        otherwise the output would depend on whether equal strings happen to be the same object
+        """
+        key = type(obj), obj
+        index = self.values.get(key)
+        if index is not None:
+            self.write(self.get(index))
+            return
+        self.dispatch_string[type(obj)](self, obj)
+        self.values[key] = self.memo[id(obj)][0]
 
     def dumps(self, obj):
         try:
@@ -122,6 +168,10 @@ class DeterministicPickler(Pickler):
     dispatch[type(Pickler)] = save_global
     # function
     dispatch[type(pickle.dump)] = save_global
+    # strings
+    dispatch_string = {str: Pickler.dispatch[str], unicode: Pickler.dispatch[unicode]}
+    dispatch[str]       = save_string
+    dispatch[unicode]   = save_string
 
     def _batch_setitems(self, items):
         # forces order of keys in dict to ensure consistent hash
@@ -129,7 +179,7 @@ class DeterministicPickler(Pickler):
 
     def save_set(self, obj):
         # forces order of items in Set to ensure consistent hash
-        Pickler.save(self, _DeterministicSet(obj))
+        Pickler.save(self, self.standin(obj, _DeterministicSet))
 
     dispatch[type(set())]       = save_set
     dispatch[type(frozenset())] = save_set
@@ -140,19 +190,25 @@ import numpy as np
 #dummy classes to pickle numpy.ndarrays in a manner that conserves aliasing information
 class _ndarray_own(object):
     def __init__(self, arr):
-        self.buffer     = np.getbuffer(arr)
+        self.data       = arr.tostring(order='A')
         self.dtype      = arr.dtype
         self.shape      = arr.shape
         self.strides    = arr.strides
 
 class _ndarray_view(object):
-    def __init__(self, arr):
-        self.base       = arr.base
-        self.offset     = self.base.ctypes.data - arr.ctypes.data   #so we have a view; but where is it?
+    def __init__(self, arr, root):
+        self.base       = root
+        self.offset     = arr.ctypes.data - root.ctypes.data    #so we have a view; but where is it?
         self.dtype      = arr.dtype
         self.shape      = arr.shape
         self.strides    = arr.strides
 
+def _ndarray_root(arr):
+    """the ndarray at the bottom of a chain of views"""
+    while isinstance(arr.base, np.ndarray):
+        arr = arr.base
+    return arr
+
 
 class NumpyDeterministicPickler(DeterministicPickler):
     """
@@ -186,11 +242,16 @@ class NumpyDeterministicPickler(DeterministicPickler):
         but we dont care, since this is only meant to be used to obtain correct keying behavior
         keys dont need to be deserialized
         """
-        if isinstance(obj, np.ndarray):
-            if obj.flags.owndata:
-                obj = _ndarray_own(obj)
+        key = cache_key(obj)
+        if key is not None:
+            obj = key
+        elif isinstance(obj, np.ndarray):
+            root = _ndarray_root(obj)
+            if root is obj:
+                #note that this includes arrays whose memory is owned by a non-numpy object
+                obj = self.standin(obj, _ndarray_own)
             else:
-                obj = _ndarray_view(obj)
+                obj = self.standin(obj, lambda arr: _ndarray_view(arr, root))
         DeterministicPickler.save(self, obj)
 
 
@@ -225,16 +286,261 @@ class NumpyDeterministicPickler(DeterministicPickler):
 ##            obj = (klass, ('HASHED', obj.dtype, obj.shape, obj.strides))
 ##        DeterministicPickler.save(self, obj)
 
+class _NotFlat(Exception):
+    """raised by the fast path upon encountering something it cannot handle"""
+
+def _track(obj, seen):
+    """
+    mutable containers may only occur once in a flat key
+    repeated occurance means either a cycle, or aliasing which is semantically relevant;
+    both of which are left to the pickler
+    """
+    i = id(obj)
+    if i in seen:
+        raise _NotFlat()
+    seen.add(i)
+
+def _flat(obj, seen):
+    try:
+        encoder = _flat_dispatch[type(obj)]
+    except KeyError:
+        raise _NotFlat()
+    return encoder(obj, seen)
+
+def _flat_str(obj, seen):
+    return 's%i:%s' % (len(obj), obj)
+def _flat_unicode(obj, seen):
+    obj = obj.encode('utf-8')
+    return 'u%i:%s' % (len(obj), obj)
+def _flat_int(obj, seen):
+    return 'i%i;' % obj
+def _flat_long(obj, seen):
+    return 'L%i;' % obj
+def _flat_float(obj, seen):
+    return 'f' + struct.pack('<d', obj)
+def _flat_bool(obj, seen):
+    return 'T' if obj else 'F'
+def _flat_none(obj, seen):
+    return 'N'
+def _flat_tuple(obj, seen):
+    return 't%i:' % len(obj) + ''.join([_flat(o, seen) for o in obj])
+def _flat_list(obj, seen):
+    _track(obj, seen)
+    return 'l%i:' % len(obj) + ''.join([_flat(o, seen) for o in obj])
+def _flat_dict(obj, seen):
+    _track(obj, seen)
+    items = sorted([(_flat(k, seen), _flat(v, seen)) for k, v in obj.iteritems()])
+    return 'd%i:' % len(items) + ''.join([k + v for k, v in items])
+def _flat_set(obj, seen):
+    _track(obj, seen)
+    return 'S%i:' % len(obj) + ''.join(sorted([_flat(o, seen) for o in obj]))
+def _flat_frozenset(obj, seen):
+    return 'Z%i:' % len(obj) + ''.join(sorted([_flat(o, seen) for o in obj]))
+
+#exact types only; subclasses may carry additional state, and are left to the pickler
+_flat_dispatch = {
+    str         : _flat_str,
+    unicode     : _flat_unicode,
+    int         : _flat_int,
+    long        : _flat_long,
+    float       : _flat_float,
+    bool        : _flat_bool,
+    type(None)  : _flat_none,
+    tuple       : _flat_tuple,
+    list        : _flat_list,
+    dict        : _flat_dict,
+    set         : _flat_set,
+    frozenset   : _flat_frozenset,
+    }
+
+#pickles start with the protocol opcode; this prefix keeps both encodings apart
+_flat_prefix = '\x00'
+
 def as_deterministic(obj):
 ##    return pickle.dumps(obj)
-    return NumpyDeterministicPickler().dumps(obj)
+    try:
+        return _flat_prefix + _flat(obj, set())
+    except _NotFlat:
+        return NumpyDeterministicPickler().dumps(obj)
 
 
 
 
+class Digest(str):
+    """
+    a precomputed digest, taken to stand for the key it was computed from
+    a merkle node is keyed identically to its digest,
+    so a cache may be called with either
+    """
+
+import weakref
+_merkle_digests = weakref.WeakKeyDictionary()  #for nodes which do not have a __dict__
+
+def _get_digest(node):
+    try:
+        return node.__dict__.get('_merkle_digest')
+    except AttributeError:
+        try:
+            return _merkle_digests.get(node)
+        except TypeError:
+            return None
+
+def _set_digest(node, digest):
+    try:
+        node.__dict__['_merkle_digest'] = digest
+    except AttributeError:
+        try:
+            _merkle_digests[node] = digest
+        except TypeError:
+            pass    #no place to cache it; it will be recomputed
+
+def merkle_digest(node):
+    """
+    digest of a node implementing the merkle protocol:
+    node.__merkle__() returns a tuple (content, children)
+    where content is any canonically encodable object describing the node itself,
+    and children is a sequence of merkle nodes
+
+    digests are cached on the nodes; hence nodes are assumed not to change,
+    or to be passed to merkle_invalidate, along with all their ancestors, when they do
+    the graph is traversed iteratively, so its depth is not limited by the recursion limit
+    """
+    digest = _get_digest(node)
+    if digest is not None:
+        return digest
+    import canonical
+    active = set()
+    stack = [(node, None)]
+    while stack:
+        node, children = stack.pop()
+        if children is None:
+            if _get_digest(node) is not None:
+                continue
+            if id(node) in active:
+                raise ValueError('Merkle graph contains a cycle')
+            content, children = node.__merkle__()
+            children = list(children)
+            pending = [child for child in children if _get_digest(child) is None]
+            if pending:
+                active.add(id(node))
+                stack.append((node, (content, children)))
+                stack.extend((child, None) for child in pending)
+                continue
+        else:
+            active.discard(id(node))
+            content, children = children
+        cls = type(node)
+        h = hashlib.sha256(cls.__module__ + '.' + cls.__name__)
+        h.update(canonical.encode(content))
+        h.update(''.join(_get_digest(child) for child in children))
+        _set_digest(node, Digest(h.digest()))
+    return _get_digest(node)
+
+class CacheKey(tuple):
+    """(type name, key) pair standing in for an object which provided its own cache key"""
+
+_cache_key_registry = {}    #type -> function returning the cache key of its instances
+
+def register_cache_key(cls, func):
+    """
+    register a function providing the cache key of instances of a type you cannot add __cache_key__ to
+    the cache key may be any canonically encodable object; typically a digest or version string.
+    it is distinguished from cache keys of other types by the type name
+    """
+    _cache_key_registry[cls] = func
+
+def cache_key(obj):
+    """
+    the object standing in for obj as a key if obj provides one, or None otherwise
+    in order of precedence, this is the registered cache key, __cache_key__(), or the merkle digest
+    """
+    cls = type(obj)
+    func = _cache_key_registry.get(cls)
+    if func is None:
+        func = getattr(cls, '__cache_key__', None)
+    if func is not None:
+        return CacheKey((cls.__module__ + '.' + cls.__name__, func(obj)))
+    if hasattr(cls, '__merkle__'):
+        return Digest(merkle_digest(obj))
+    return None
+
+def merkle_invalidate(node):
+    """discard the cached digest of a node"""
+    try:
+        node.__dict__.pop('_merkle_digest', None)
+    except AttributeError:
+        _merkle_digests.pop(node, None)
+
+
+
+class Dummy(object):
+    pass
+
+class Document(object):
+    """large object with a known version, for demonstration purposes"""
+    def __init__(self, version):
+        self.version = version
+        self.content = np.random.rand(1000000)
+    def __cache_key__(self):
+        return self.version
+
+class Node(object):
+    """merkle node of an expression graph, for demonstration purposes"""
+    def __init__(self, op, *children):
+        self.op = op
+        self.children = children
+    def __merkle__(self):
+        return self.op, self.children
+
 if __name__=='__main__':
 
     k1, k2 = {1: 0, 9: 0}, {9: 0, 1: 0}
 
     print len(as_deterministic(k1))
-    print pickle.loads(as_deterministic(k2))
\ No newline at end of file
+    assert as_deterministic(k1) == as_deterministic(k2)
+    #aliased containers are left to the pickler
+    l = [1]
+    assert as_deterministic((l, l)) != as_deterministic(([1], [1]))
+    print pickle.loads(NumpyDeterministicPickler().dumps(k2))
+
+    from time import time
+
+    #equal strings are memoized by value
+    s = 'source' * 1000
+    assert as_deterministic([s, s, Dummy()]) == as_deterministic([s, ''.join(['source'] * 1000), Dummy()])
+    assert len(as_deterministic([s] * 50 + [Dummy()])) < 2 * len(s)
+    #cycles
+    l = [1]
+    l.append(l)
+    print len(as_deterministic(l))
+    #aliasing of ndarrays; contents matter, and views on the same memory are recognized
+    a = np.arange(10)
+    assert as_deterministic(a) != as_deterministic(a + 1)
+    assert as_deterministic((a[1:], a[:-1])) != as_deterministic((a[1:].copy(), a[:-1].copy()))
+    assert as_deterministic((a[1:], a[:-1])) != as_deterministic((a[:-1], a[1:]))
+    print len(as_deterministic((a[1:], a[:-1], a[::2])))
+
+    #objects providing their own cache key are not traversed
+    docs = Document('v1'), Document('v1')
+    t = time()
+    assert as_deterministic(docs[0]) == as_deterministic(docs[1])
+    print 'cache key', time() - t
+
+    #rekeying a large graph after an edit only digests the changed nodes
+    nodes = [Node(i) for i in range(2**16)]
+    while len(nodes) > 1:
+        nodes = [Node('+', l, r) for l, r in zip(nodes[::2], nodes[1::2])]
+    root = nodes[0]
+    t = time()
+    assert as_deterministic(root) == as_deterministic(merkle_digest(root))
+    print 'initial', time() - t
+    node, path = root, []
+    while node.children:
+        path.append(node)
+        node = node.children[0]
+    edited = Node(-1)
+    for parent in reversed(path):
+        edited = Node(parent.op, edited, *parent.children[1:])
+    t = time()
+    merkle_digest(edited)
+    print 'rekey', time() - t
\ No newline at end of file
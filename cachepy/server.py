@@ -0,0 +1,530 @@
+
+"""
+cache server, and a shelve backend talking to it
+
+sharing a cache between the nodes of a cluster by placing its sqlite file on NFS works,
+but every transaction then involves lock files on a network filesystem, which caps the
+whole cluster at a handful of transactions per second. instead, a single server process
+may own the sqlite files, and serve any number of clients over a socket
+
+the protocol is a compact binary one; every message is a frame consisting of
+a one byte opcode or status, the payload length as a 4 byte little endian integer,
+and a payload of length prefixed fields. keys travel in their canonical encoding along with their hash,
+and values as encoded by the client; the server never unpickles anything.
+responses are returned in the order of the requests, so clients may pipeline batches of requests
+
+the server takes care of locking; every request is atomic, so clients need no lock files.
+deferred tokens remain ordinary values as far as the server is concerned, but they are placed by
+a compare and set, such that only one client claims a missing or expired entry; and rather than polling,
+clients waiting for a deferred value block on the server until its entry is written to
+
+a server is started with
+    python server.py [--root directory] (host:port | unix socket path)
+and a cache uses it by passing server=(host, port), or the socket path, to AbstractCache
+"""
+
+import os
+import re
+import sys
+import errno
+import hashlib
+import socket
+import struct
+import logging
+import threading
+import SocketServer
+from Queue import Queue, Empty, Full
+from time import time
+
+from shelve2 import Shelve, Future, process_key, encode, decode
+
+
+logger = logging.getLogger('cachepy.server')
+
+
+#opcodes
+OPEN, GET, ROWID, SET, DELETE, WAIT, CLEAR, STATS, SYNC, CLAIM, DURABLE = range(1, 12)
+#statuses
+OK, MISS, ERROR = range(3)
+
+_header = struct.Struct('<BI')
+_length = struct.Struct('<I')
+_int = struct.Struct('<q')
+_float = struct.Struct('<d')
+
+
+def pack(code, fields=()):
+    """a frame holding a sequence of byte strings"""
+    payload = ''.join([_length.pack(len(field)) + field for field in fields])
+    return _header.pack(code, len(payload)) + payload
+
+def unpack(payload):
+    fields = []
+    i = 0
+    while i < len(payload):
+        n, = _length.unpack_from(payload, i)
+        i += _length.size
+        fields.append(payload[i:i+n])
+        i += n
+    return fields
+
+def read_frame(rfile):
+    header = rfile.read(_header.size)
+    if len(header) < _header.size:
+        raise EOFError()
+    code, n = _header.unpack(header)
+    payload = rfile.read(n)
+    if len(payload) < n:
+        raise EOFError()
+    return code, unpack(payload)
+
+
+class RemoteError(Exception):
+    """an error raised by the server while handling a request"""
+
+
+class _Namespace(object):
+    """
+    the database of a single cache on the server, and the bookkeeping of clients waiting on it
+    writes are tallied per hash bucket rather than per key, so memory use is bounded;
+    a collision merely wakes up a waiter for nothing
+    """
+    buckets = 4096
+
+    def __init__(self, filename, commit_window):
+        self.shelve     = Shelve(filename, autocommit=True, commit_window=commit_window)
+        self.changed    = threading.Condition(threading.Lock())
+        self.sequence   = 0                         #number of writes so far
+        self.written    = [0] * self.buckets        #sequence number of the last write per bucket
+        self.lock       = threading.Lock()          #makes compare and set atomic
+
+    def touch(self, keyhash):
+        """register a write; to be called once the write has been queued"""
+        with self.changed:
+            self.sequence += 1
+            self.written[keyhash % self.buckets] = self.sequence
+            self.changed.notify_all()
+
+    def wait(self, keyhash, sequence, timeout):
+        """wait for a write to the bucket of keyhash after the given sequence number"""
+        bucket = keyhash % self.buckets
+        expired = []
+        def expire():
+            with self.changed:
+                expired.append(True)
+                self.changed.notify_all()
+        #timed waits poll under python 2; wake ourselves up instead
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        with self.changed:
+            timer.start()
+            while self.written[bucket] <= sequence and not expired:
+                self.changed.wait()
+        timer.cancel()
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    """serves the requests of a single connection, in order"""
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        if self.connection.family != getattr(socket, 'AF_UNIX', None):
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        namespace = None
+        while True:
+            try:
+                code, fields = read_frame(self.rfile)
+            except (EOFError, socket.error):
+                return
+            try:
+                if code == OPEN:
+                    namespace = self.server.open(fields[0])
+                    status, result = OK, []
+                elif namespace is None:
+                    raise ValueError('No cache opened on this connection')
+                else:
+                    status, result = OK, self.dispatch(namespace, code, fields)
+            except KeyError:
+                status, result = MISS, []
+            except Exception as e:
+                logger.exception('Request %i failed', code)
+                status, result = ERROR, [repr(e)]
+            try:
+                self.wfile.write(pack(status, result))
+            except socket.error:
+                return
+
+    def dispatch(self, namespace, code, fields):
+        shelve = namespace.shelve
+        if code in (GET, ROWID, SET, DELETE, CLAIM):
+            #blobs are compared as buffers
+            keystr, keyhash = buffer(fields[0]), _int.unpack(fields[1])[0]
+        if code == GET:
+            sequence = namespace.sequence
+            return [str(shelve.getraw(keystr, keystr, keyhash)), _int.pack(sequence)]
+        if code == ROWID:
+            return [_int.pack(shelve.getrowid(keystr, keystr, keyhash))]
+        if code == SET:
+            with namespace.lock:
+                shelve.setraw(keystr, buffer(fields[2]), keystr, keyhash)
+            namespace.touch(keyhash)
+            return []
+        if code == CLAIM:
+            #write only if the entry is still as the client last saw it; absent if the digest is empty
+            with namespace.lock:
+                try:
+                    current = hashlib.sha1(shelve.getraw(keystr, keystr, keyhash)).digest()
+                except KeyError:
+                    current = ''
+                if current != fields[3]:
+                    raise KeyError()
+                shelve.setraw(keystr, buffer(fields[2]), keystr, keyhash)
+            namespace.touch(keyhash)
+            return []
+        if code == DELETE:
+            with namespace.lock:
+                shelve.delitem(keystr, keystr, keyhash)
+            namespace.touch(keyhash)
+            return []
+        if code == WAIT:
+            keyhash, sequence, timeout = _int.unpack(fields[0])[0], _int.unpack(fields[1])[0], _float.unpack(fields[2])[0]
+            namespace.wait(keyhash, sequence, timeout)
+            return []
+        if code == CLEAR:
+            shelve.clear()
+            with namespace.changed:
+                namespace.sequence += 1
+                namespace.written = [namespace.sequence] * namespace.buckets
+                namespace.changed.notify_all()
+            return []
+        if code == STATS:
+            stats = shelve.stats()
+            return [_int.pack(stats[k]) for k in ['rows', 'key_bytes', 'value_bytes']]
+        if code == SYNC:
+            shelve.commit().wait()
+            return []
+        if code == DURABLE:
+            #replies once the writes before it are committed by the group commit, without forcing one
+            shelve.durable().wait()
+            return []
+        raise ValueError('Unknown opcode %i' % code)
+
+
+class _Server(object):
+    """state shared by the handlers; a namespace per cache identifier"""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def init(self, root, commit_window):
+        self.root           = root
+        self.commit_window  = commit_window
+        self.namespaces     = {}
+        self.namespaces_lock = threading.Lock()
+        try:
+            os.makedirs(root)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def open(self, name):
+        if not re.match(r'^[\w.-]+$', name):
+            raise ValueError('Invalid cache name %r' % name)
+        with self.namespaces_lock:
+            try:
+                return self.namespaces[name]
+            except KeyError:
+                namespace = self.namespaces[name] = _Namespace(os.path.join(self.root, name), self.commit_window)
+                return namespace
+
+class TCPCacheServer(_Server, SocketServer.ThreadingTCPServer):
+    def __init__(self, address, root, commit_window=0.01):
+        self.init(root, commit_window)
+        SocketServer.ThreadingTCPServer.__init__(self, address, _Handler)
+
+if hasattr(socket, 'AF_UNIX'):
+    class UnixCacheServer(_Server, SocketServer.ThreadingUnixStreamServer):
+        def __init__(self, address, root, commit_window=0.01):
+            self.init(root, commit_window)
+            if os.path.exists(address):
+                os.remove(address)
+            SocketServer.ThreadingUnixStreamServer.__init__(self, address, _Handler)
+
+def CacheServer(address, root, commit_window=0.01):
+    """a server listening on a (host, port) tuple, or on a unix socket path"""
+    if isinstance(address, basestring):
+        return UnixCacheServer(address, root, commit_window)
+    return TCPCacheServer(address, root, commit_window)
+
+
+class _Connection(object):
+    def __init__(self, address, name):
+        if isinstance(address, basestring):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.connect(address)
+        self.rfile = self.sock.makefile('rb')
+        status, fields = self.request([(OPEN, [name])])[0]
+        if status != OK:
+            raise RemoteError(fields[0] if fields else 'Failed to open %s' % name)
+
+    def request(self, frames):
+        """send a batch of requests at once, and read all responses"""
+        self.sock.sendall(''.join([pack(code, fields) for code, fields in frames]))
+        return [read_frame(self.rfile) for frame in frames]
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+class RemoteShelve(object):
+    """
+    client of a cache server, implementing the interface of shelve2.Shelve used by AbstractCache
+    connections are pooled, such that threads do not queue up behind each other's requests
+    note that iteration over a remote shelve is not supported
+    """
+    locks_itself = True
+    pipeline = 128      #number of requests per round trip in batch operations
+
+    def __init__(self, address, name, pool_size=4, metrics=None):
+        from metrics import select_metrics
+        self.address    = address
+        self.name       = name
+        self.pool       = Queue(pool_size)
+        self.metrics    = select_metrics(metrics, name)
+        self.seen       = threading.local()     #sequence number of the last read per thread; see wait
+        self.pid        = os.getpid()
+
+    def _request(self, frames):
+        if self.pid != os.getpid():
+            #we have been forked; the pooled connections belong to our parent
+            self.pool, self.pid = Queue(self.pool.maxsize), os.getpid()
+        try:
+            conn = self.pool.get_nowait()
+        except Empty:
+            conn = _Connection(self.address, self.name)
+        try:
+            with self.metrics.span('remote', requests=len(frames)):
+                responses = conn.request(frames)
+        except:
+            #the state of the stream is unknown; do not reuse it
+            conn.close()
+            raise
+        try:
+            self.pool.put_nowait(conn)
+        except Full:
+            conn.close()
+        return responses
+
+    def _call(self, code, *fields):
+        status, result = self._request([(code, fields)])[0]
+        return self._check(status, result)
+
+    def _check(self, status, result):
+        if status == MISS:
+            raise KeyError()
+        if status == ERROR:
+            raise RemoteError(result[0])
+        return result
+
+    def getrowid(self, key, keystr, keyhash):
+        try:
+            return _int.unpack(self._call(ROWID, str(keystr), _int.pack(keyhash))[0])[0]
+        except KeyError:
+            raise KeyError(key)
+
+    def getraw(self, key, keystr, keyhash):
+        try:
+            valuestr, sequence = self._call(GET, str(keystr), _int.pack(keyhash))
+        except KeyError:
+            self.seen.keystr, self.seen.sequence, self.seen.digest = str(keystr), 0, ''
+            raise KeyError(key)
+        self.seen.keystr, self.seen.sequence = str(keystr), _int.unpack(sequence)[0]
+        self.seen.digest = hashlib.sha1(valuestr).digest()
+        self.metrics.count('bytes_read', len(valuestr))
+        return valuestr
+
+    def getitem(self, key, keystr, keyhash):
+        valuestr = self.getraw(key, keystr, keyhash)
+        with self.metrics.span('decode'):
+            return decode(valuestr)
+
+    def _set_frame(self, value, keystr, keyhash):
+        with self.metrics.span('encode'):
+            valuestr = str(encode(value))
+        self.metrics.count('bytes_written', len(valuestr) + len(keystr))
+        return SET, [str(keystr), _int.pack(keyhash), valuestr]
+
+    def setitem(self, key, value, keystr, keyhash):
+        """write a single value; like with a group committing Shelve, it is committed shortly after we return"""
+        status, result = self._request([self._set_frame(value, keystr, keyhash)])[0]
+        self._check(status, result)
+
+    def setitems(self, items):
+        """
+        write a sequence of (key, value, keystr, keyhash) in pipelined batches, and block until committed
+        the server replies to a write as soon as it is queued; a closing request waits for the group commit
+        """
+        frames = [self._set_frame(value, keystr, keyhash) for key, value, keystr, keyhash in items]
+        frames.append((DURABLE, []))
+        for i in xrange(0, len(frames), self.pipeline):
+            for status, result in self._request(frames[i:i+self.pipeline]):
+                self._check(status, result)
+
+    def claim(self, key, value, keystr, keyhash):
+        """
+        write value, provided the entry under key is unchanged since this thread last read it,
+        or absent if it has not read it. returns whether the value was written
+        """
+        expected = self.seen.digest if getattr(self.seen, 'keystr', None) == str(keystr) else ''
+        try:
+            self._call(CLAIM, str(keystr), _int.pack(keyhash), str(encode(value)), expected)
+            return True
+        except KeyError:
+            return False
+
+    def getitems(self, keys):
+        """look up a sequence of keys in pipelined batches; missing keys map to KeyError instances"""
+        frames = []
+        for key in keys:
+            keystr, keyhash = process_key(key)
+            frames.append((GET, [str(keystr), _int.pack(keyhash)]))
+        values = []
+        for i in xrange(0, len(frames), self.pipeline):
+            for key, (status, result) in zip(keys[i:i+self.pipeline], self._request(frames[i:i+self.pipeline])):
+                try:
+                    values.append(decode(self._check(status, result)[0]))
+                except KeyError:
+                    values.append(KeyError(key))
+        return values
+
+    def delitem(self, key, keystr, keyhash):
+        try:
+            self._call(DELETE, str(keystr), _int.pack(keyhash))
+        except KeyError:
+            raise KeyError(key)
+
+    def wait(self, key, keystr, keyhash, timeout):
+        """block until the entry under key is written to, since this thread last read it, or timeout seconds pass"""
+        sequence = self.seen.sequence if getattr(self.seen, 'keystr', None) == str(keystr) else 0
+        self._call(WAIT, _int.pack(keyhash), _int.pack(sequence), _float.pack(timeout))
+
+    def __getitem__(self, key):
+        return self.getitem(key, *process_key(key))
+    def __setitem__(self, key, value):
+        self.setitem(key, value, *process_key(key))
+    def __delitem__(self, key):
+        self.delitem(key, *process_key(key))
+    def __contains__(self, key):
+        try:
+            self.getrowid(key, *process_key(key))
+            return True
+        except KeyError:
+            return False
+
+    def stats(self):
+        rows, keybytes, valuebytes = [_int.unpack(f)[0] for f in self._call(STATS)]
+        return dict(rows=rows, key_bytes=keybytes, value_bytes=valuebytes)
+    def __len__(self):
+        return self.stats()['rows']
+    def __nonzero__(self):
+        return len(self) > 0
+
+    def clear(self):
+        self._call(CLEAR)
+
+    def commit(self):
+        """make the server commit all writes so far; returns a resolved Future, for compatibility with Shelve"""
+        future = Future()
+        try:
+            self._call(SYNC)
+            future.set()
+        except Exception as e:
+            future.set(e)
+        return future
+    sync = commit
+
+    def durable(self):
+        """wait for the server to commit all writes so far, without forcing a commit; returns a resolved Future"""
+        future = Future()
+        try:
+            self._call(DURABLE)
+            future.set()
+        except Exception as e:
+            future.set(e)
+        return future
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except Empty:
+                return
+
+
+
+def serve(address, root, commit_window=0.01):
+    server = CacheServer(address, root, commit_window)
+    logger.info('Serving caches in %s on %s', root, address)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def parse_address(address):
+    if ':' in address and not os.path.sep in address:
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+    return address
+
+
+if __name__=='__main__':
+    import tempfile
+    args = sys.argv[1:]
+    root = os.path.join(tempfile.gettempdir(), 'cachepy', 'server')
+    if '--root' in args:
+        i = args.index('--root')
+        root = args[i+1]
+        del args[i:i+2]
+    if args:
+        logging.basicConfig(level=logging.INFO)
+        serve(parse_address(args[0]), root)
+    else:
+        #demo; run a server in a separate process, and hammer it from a few threads
+        import subprocess
+        import multiprocessing.dummy
+        address = os.path.join(tempfile.gettempdir(), 'cachepy_demo.sock')
+        if os.path.exists(address):
+            os.remove(address)
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), address])
+        try:
+            from time import sleep
+            while not os.path.exists(address):
+                sleep(0.01)
+            shelve = RemoteShelve(address, 'demo')
+            shelve.clear()
+            shelve['a'] = 1
+            assert shelve['a'] == 1 and 'a' in shelve and 'b' not in shelve
+            del shelve['a']
+            assert len(shelve) == 0
+
+            n = 10000
+            start = time()
+            for i in range(0, n, 1000):
+                shelve.setitems([(i+j, i+j) + process_key(i+j) for j in range(1000)])
+            print 'pipelined writes per second', n / (time() - start)
+            start = time()
+            for i in range(0, n, 1000):
+                assert shelve.getitems(range(i, i+1000)) == range(i, i+1000)
+            print 'pipelined reads per second', n / (time() - start)
+            start = time()
+            pool = multiprocessing.dummy.Pool(4)
+            assert pool.map(shelve.__getitem__, range(n)) == range(n)
+            print 'reads per second, 4 threads', n / (time() - start)
+            print shelve.stats()
+        finally:
+            process.terminate()
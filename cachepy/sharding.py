@@ -0,0 +1,311 @@
+
+"""
+consistent hash sharding of a shelve over multiple sqlite files
+
+a single sqlite file admits a single writer at a time, and a cache guarded by a single lock file
+serializes all misses of all processes on it. splitting the keys over several files,
+each with a lock of its own, lets misses on different keys proceed concurrently
+
+keys are assigned to shards by their hash, on a ring of virtual nodes, such that changing the number
+of shards only moves the keys of the shards gained or lost. the number of shards is recorded next to
+the shard files, and a shelve opened with a different number rebalances the existing entries
+
+rowids are local to a shard, and change when an entry moves to another shard; but the hierarchical
+keys of a cache refer to their parent by rowid. a sharded shelve therefore identifies an entry by
+a 128 bit digest of its key instead, which is the same in every shard
+
+every operation of a sharded shelve is atomic, under the lock of its shard. rather than holding a lock
+over a sequence of operations, a deferred token is placed by compare and set; see claim
+"""
+
+import os
+import glob
+import bisect
+import hashlib
+import threading
+
+import lockfile.mkdirlockfile as lockfile
+
+import canonical
+from shelve2 import Shelve, process_key, decode
+from metrics import select_metrics
+
+
+class FutureSet(object):
+    """future completing once all of a number of futures are"""
+    def __init__(self, futures):
+        self.futures = list(futures)
+    def done(self):
+        return all(f.done() for f in self.futures)
+    def wait(self, timeout=None):
+        return all([f.wait(timeout) for f in self.futures])
+    def result(self):
+        return [f.result() for f in self.futures]
+
+
+class _Shard(object):
+    def __init__(self, filename, lock_timeout, **kwargs):
+        self.filename   = filename
+        self.lock_timeout = lock_timeout
+        self.shelve     = Shelve(filename, **kwargs)
+        self._locks()
+    def _locks(self):
+        #the lock file object identifies its owning thread and process, so threads take turns using it,
+        #and a forked child needs one of its own
+        self.pid        = os.getpid()
+        self.lock       = threading.Lock()
+        self.lock_file  = lockfile.MkdirLockFile(self.filename, timeout=self.lock_timeout)
+    def __enter__(self):
+        if self.pid != os.getpid():
+            self._locks()
+        self.lock.acquire()
+        try:
+            self.lock_file.acquire()
+        except:
+            self.lock.release()
+            raise
+        return self.shelve
+    def __exit__(self, type, value, traceback):
+        self.lock_file.release()
+        self.lock.release()
+
+
+class ShardedShelve(object):
+    """
+    implements the interface of shelve2.Shelve used by AbstractCache, over a number of shard files
+    named filename.shard0, filename.shard1, and so on
+    """
+    locks_itself = True
+    vnodes = 64         #points per shard on the hash ring
+
+    def __init__(self, filename, shards=4, lock_timeout=1, metrics=None, **kwargs):
+        """
+        remaining keyword arguments are passed on to the Shelve of each shard
+        """
+        self.filename       = filename
+        self.metrics        = select_metrics(metrics, filename)
+        self.lock_timeout   = lock_timeout
+        self.kwargs         = dict(kwargs, metrics=self.metrics)
+        self.seen           = threading.local()     #digest of the last value read per thread; see claim
+        self.shards         = [self._open(i) for i in range(shards)]
+        self.ring           = sorted((canonical.hash64('shard%i-%i' % (i, v)), i)
+                                     for i in range(shards) for v in range(self.vnodes))
+        self.points         = [point for point, i in self.ring]
+
+        countfile = filename + '.shards'
+        try:
+            with open(countfile) as f:
+                previous = int(f.read())
+        except (IOError, ValueError):
+            previous = shards
+        if previous != shards or self._orphans():
+            self.rebalance()
+        with open(countfile, 'w') as f:
+            f.write(str(shards))
+
+    def _open(self, i):
+        return _Shard('%s.shard%i' % (self.filename, i), self.lock_timeout, **self.kwargs)
+
+    def _orphans(self):
+        """shard files beyond the current number of shards"""
+        n = len(self.shards)
+        orphans = []
+        for path in glob.glob(self.filename + '.shard*'):
+            suffix = path[len(self.filename + '.shard'):]
+            if suffix.isdigit() and int(suffix) >= n:
+                orphans.append(path)
+        return orphans
+
+    def shard(self, keyhash):
+        """the shard owning a key hash"""
+        i = bisect.bisect(self.points, keyhash) % len(self.ring)
+        return self.shards[self.ring[i][1]]
+
+    def rebalance(self):
+        """move all entries to the shard owning them under the current number of shards"""
+        orphans = [_Shard(path, self.lock_timeout, **self.kwargs) for path in self._orphans()]
+        moved = 0
+        for source in self.shards + orphans:
+            with source as shelve:
+                misplaced = [(keyhash, keystr, valuestr) for keyhash, keystr, valuestr
+                             in shelve.scan(['hash', 'key', 'value'])
+                             if self.shard(keyhash) is not source]
+            targets = {}
+            for keyhash, keystr, valuestr in misplaced:
+                targets.setdefault(self.shard(keyhash), []).append((keyhash, keystr, valuestr))
+            #copy before deleting; should we be interrupted, the next rebalance finishes the job
+            for target, rows in targets.items():
+                with target as shelve:
+                    for keyhash, keystr, valuestr in rows:
+                        shelve.setraw(keystr, valuestr, keystr, keyhash)
+                    shelve.commit().wait()
+            with source as shelve:
+                for keyhash, keystr, valuestr in misplaced:
+                    shelve.delitem(keystr, keystr, keyhash)
+                shelve.commit().wait()
+            moved += len(misplaced)
+        for orphan in orphans:
+            orphan.shelve.terminate()
+        self.metrics.count('rebalanced', moved)
+        return moved
+
+    @staticmethod
+    def _rowid(keystr):
+        return int(hashlib.sha256(str(keystr)).hexdigest()[:32], 16)
+
+    def getrowid(self, key, keystr, keyhash):
+        """identifier of an entry; a digest of its key, such that it survives rebalancing"""
+        self.shard(keyhash).shelve.getrowid(key, keystr, keyhash)
+        return self._rowid(keystr)
+
+    def getraw(self, key, keystr, keyhash):
+        try:
+            valuestr = self.shard(keyhash).shelve.getraw(key, keystr, keyhash)
+        except KeyError:
+            self.seen.keystr, self.seen.digest = str(keystr), ''
+            raise
+        self.seen.keystr, self.seen.digest = str(keystr), hashlib.sha1(valuestr).digest()
+        return valuestr
+
+    def getitem(self, key, keystr, keyhash):
+        valuestr = self.getraw(key, keystr, keyhash)
+        with self.metrics.span('decode'):
+            return decode(valuestr)
+
+    def setitem(self, key, value, keystr, keyhash):
+        with self.shard(keyhash) as shelve:
+            shelve.setitem(key, value, keystr, keyhash)
+
+    def setitems(self, items):
+        """write a sequence of (key, value, keystr, keyhash), in a transaction per shard"""
+        byshard = {}
+        for item in items:
+            byshard.setdefault(self.shard(item[3]), []).append(item)
+        for shard, items in byshard.items():
+            with shard as shelve:
+                shelve.setitems(items)
+
+    def claim(self, key, value, keystr, keyhash):
+        """
+        write value, provided the entry under key is unchanged since this thread last read it,
+        or absent if it has not read it. returns whether the value was written
+        """
+        expected = self.seen.digest if getattr(self.seen, 'keystr', None) == str(keystr) else ''
+        with self.shard(keyhash) as shelve:
+            try:
+                current = hashlib.sha1(shelve.getraw(key, keystr, keyhash)).digest()
+            except KeyError:
+                current = ''
+            if current != expected:
+                return False
+            shelve.setitem(key, value, keystr, keyhash)
+            #our claim needs to be visible to other processes before we release the lock
+            shelve.commit().wait()
+            return True
+
+    def delitem(self, key, keystr, keyhash):
+        with self.shard(keyhash) as shelve:
+            shelve.delitem(key, keystr, keyhash)
+
+    def wait(self, key, keystr, keyhash, timeout):
+        self.shard(keyhash).shelve.wait(key, keystr, keyhash, timeout)
+
+    def __getitem__(self, key):
+        return self.getitem(key, *process_key(key))
+    def __setitem__(self, key, value):
+        self.setitem(key, value, *process_key(key))
+    def __delitem__(self, key):
+        self.delitem(key, *process_key(key))
+    def __contains__(self, key):
+        keystr, keyhash = process_key(key)
+        try:
+            self.shard(keyhash).shelve.getrowid(key, keystr, keyhash)
+            return True
+        except KeyError:
+            return False
+
+    def iterkeys(self):
+        for shard in self.shards:
+            for key in shard.shelve.iterkeys():
+                yield key
+    def itervalues(self):
+        for shard in self.shards:
+            for value in shard.shelve.itervalues():
+                yield value
+    def iteritems(self):
+        for shard in self.shards:
+            for item in shard.shelve.iteritems():
+                yield item
+    def iterraw(self):
+        """iterate over (rowid, encoded key, encoded value) of all shards in turn; rowids as returned by getrowid"""
+        for shard in self.shards:
+            for keystr, valuestr in shard.shelve.scan(['key', 'value']):
+                yield self._rowid(keystr), keystr, valuestr
+    def keys(self):
+        return list(self.iterkeys())
+    def values(self):
+        return list(self.itervalues())
+    def items(self):
+        return list(self.iteritems())
+    __iter__ = iterkeys
+
+    def stats(self):
+        stats = [shard.shelve.stats() for shard in self.shards]
+        total = {k: sum(s[k] for s in stats) for k in stats[0]}
+        total['shards'] = stats
+        return total
+    def __len__(self):
+        return sum(len(shard.shelve) for shard in self.shards)
+    def __nonzero__(self):
+        return any(shard.shelve for shard in self.shards)
+
+    def clear(self):
+        for shard in self.shards:
+            with shard as shelve:
+                shelve.clear()
+
+    def commit(self):
+        return FutureSet(shard.shelve.commit() for shard in self.shards)
+    sync = commit
+    def durable(self):
+        return FutureSet(shard.shelve.durable() for shard in self.shards)
+
+    def compact(self):
+        """compact each shard in turn, under its lock"""
+        for shard in self.shards:
+            with shard as shelve:
+                shelve.compact().wait()
+        return FutureSet([])
+
+    def close(self):
+        for shard in self.shards:
+            shard.shelve.close()
+
+
+
+if __name__=='__main__':
+    import tempfile
+    filename = os.path.join(tempfile.gettempdir(), 'cachepy_sharding_demo')
+    for path in glob.glob(filename + '*'):
+        os.remove(path)
+    shelve = ShardedShelve(filename, shards=4, autocommit=True)
+    for i in range(1000):
+        shelve[i] = str(i)
+    print [s['rows'] for s in shelve.stats()['shards']]
+    rowid = shelve.getrowid(7, *process_key(7))
+    shelve.close()
+
+    #growing from 4 to 5 shards moves about a fifth of the entries
+    shelve = ShardedShelve(filename, shards=5, autocommit=True, metrics=True)
+    print 'moved', shelve.metrics.snapshot()['counters']['rebalanced'], [s['rows'] for s in shelve.stats()['shards']]
+    assert len(shelve) == 1000
+    assert all(shelve[i] == str(i) for i in range(1000))
+    assert shelve.getrowid(7, *process_key(7)) == rowid
+    shelve.close()
+
+    #and shrinking back moves them back
+    shelve = ShardedShelve(filename, shards=4, autocommit=True, metrics=True)
+    print 'moved', shelve.metrics.snapshot()['counters']['rebalanced']
+    assert len(shelve) == 1000 and not os.path.exists(filename + '.shard4')
+    assert all(shelve[i] == str(i) for i in range(1000))
+    print 'all tests passed'
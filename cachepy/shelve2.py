@@ -11,6 +11,17 @@ the design is an sqlite3 database, with a table containing key and value blobs,
 which are indexed by a hash of the given key
 this allows for efficient mapping of complex python objects to complex python objects
 
+keys are stored in their canonical encoding (see the canonical module),
+such that they do not depend on the pickle protocol or interpreter version
+
+with dedup enabled, values are stored once per distinct content, in a blobs table keyed by their digest,
+and rows hold a reference to them; this works across the tables of all caches sharing a database.
+reference counts are maintained by triggers, and a blob is deleted once no row refers to it anymore,
+unless it was written within the last minute; a writer may be about to refer to it. collect sweeps those
+
+databases are created with incremental auto vacuum, such that the free pages left behind by deletes
+can be returned to the filesystem a few at a time; see the maintenance module
+
 This code is adapted from the sqlitedict code from author below
 """
 
@@ -44,20 +55,38 @@ import os
 import tempfile
 import random
 import logging
+import weakref
 from cPickle import dumps, loads
 from UserDict import DictMixin
 from Queue import Queue
-from threading import Thread
+from threading import Thread, Event, Timer
+from time import time, sleep
 import util
 
-import numpy as np
 import hashlib
 import zlib
-from serialization import as_deterministic
+import canonical
+from metrics import select_metrics
 
 
 logger = logging.getLogger('sqlitedict')
 
+REFERENCE = '\x00'      #prefix of a reference to a blob; zlib streams never start with a null byte
+
+#all shelves open in this process
+_shelves = weakref.WeakSet()
+
+def prepare_fork():
+    """
+    commit the pending writes of all autocommitting shelves in this process;
+    whatever is still queued when the process forks is committed by the parent only,
+    so a child would not see it
+    """
+    for shelve in list(_shelves):
+        conn = shelve._conn
+        if conn is not None and conn.autocommit and shelve._pid == os.getpid():
+            conn.commit().wait()
+
 
 
 def open(*args, **kwargs):
@@ -79,16 +108,25 @@ def decode(obj):
 def hashing(strobj):
     return hashlib.sha256(strobj).digest()
 
-def hash_str_to_u64(strobj):
-    """is this desirable? maintaining a list of strings is hardly different than a list of numbers, given that sqlite3 uses variable length stuff anyway"""
-    return reduce(np.bitwise_xor, np.frombuffer(hashing(strobj), dtype=np.uint64)) + 1
+def process_key(key):
+    """
+    map a key to its canonical encoding and the 64 bit hash under which it is indexed
+    objects providing their own cache key are encoded by that key alone; see serialization.cache_key
+    """
+    keystr = canonical.encode(key)
+    keyhash = canonical.hash64(keystr)
+    return sqlite3.Binary(keystr), keyhash
 
+def decode_key(keystr):
+    return canonical.decode(keystr)
 
-def process_key(key):
-    dkey = as_deterministic(key)
-    keystr = encode(dkey)
-    keyhash = hash_str_to_u64(keystr)
-    return keystr, keyhash
+#codecs of shelves which do without deterministic keys or compressed values
+def _pickle_key(key):
+    return dumps(key, protocol=util.pickle_protocol)
+def _pickle_value(obj):
+    return sqlite3.Binary(dumps(obj, protocol=util.pickle_protocol))
+def _unpickle_value(obj):
+    return loads(str(obj))
 
 class Key(object):
     """use this upcasting mechanism thoughout the code; much cleaner"""
@@ -100,8 +138,11 @@ class Key(object):
 
 
 class Shelve(object, DictMixin):
+    locks_itself = False    #a shelve relies on its user to guard sequences of operations with a lock file
     def __init__(self, filename=None, flag='c',
-                 autocommit=False, journal_mode="DELETE"):
+                 autocommit=False, journal_mode="DELETE", metrics=None,
+                 commit_window=None, commit_size=1000, tablename='dict', dedup=False,
+                 exact=True, deterministic=True, zip=True):
         """
         Initialize a thread-safe sqlite-backed dictionary. The dictionary will
         be a table `tablename` in database file `filename`. A single file (=database)
@@ -114,9 +155,30 @@ class Shelve(object, DictMixin):
         (more inefficient but safer). Otherwise, changes are committed on `self.commit()`,
         `self.clear()` and `self.close()`.
 
+        Setting `commit_window` in addition to `autocommit` enables group commit;
+        writes are gathered into a single transaction, which is committed at most
+        `commit_window` seconds after its first write, or once it holds `commit_size`
+        statements, whichever comes first. Call `self.durable()` to obtain a future
+        which resolves once everything written before it is committed.
+
         Set `journal_mode` to 'OFF' if you're experiencing sqlite I/O problems
         or if you need performance and don't care about crash-consistency.
 
+        Enabling `dedup` stores each distinct value once per database, however many
+        rows of however many tables hold it; see above. A table once written with
+        dedup keeps resolving references when opened without.
+
+        `metrics` enables instrumentation of sqlite and (de)serialization time
+        and the number of bytes read and written; see the metrics module.
+
+        Keys and values are stored in a form which outlives the process by default.
+        Where that is not needed, dropping features saves space and time:
+        `exact=False` stores only a digest of each key; equal digests of unequal keys go unnoticed,
+        and the keys can no longer be listed. `deterministic=False` encodes keys by cPickle rather
+        than canonically; pickles of equal keys may differ, which costs a miss, and change between
+        interpreter versions, which costs all of them. `zip=False` stores values uncompressed.
+        A table is to be opened with the same choices as it was written with.
+
         The `flag` parameter:
           'c': default mode, open for read/write, creating the db/table if necessary.
           'w': open for r/w, but drop `tablename` contents first (start with empty table)
@@ -128,57 +190,225 @@ class Shelve(object, DictMixin):
                 os.remove(filename)
 
         self.filename = filename
+        self.tablename = tablename
+        self.metrics = select_metrics(metrics, filename)
+        self.exact = exact
+        self.deterministic = deterministic
+        self.zip = zip
+        if deterministic and exact:
+            #the common case; the module level functions, without further ado
+            self.process_key = process_key
+        self.encode_key = canonical.encode if deterministic else _pickle_key
+        if not zip:
+            self.encode_value, self.decode_value = _pickle_value, _unpickle_value
+        #the original table keeps its original names
+        prefix = '' if tablename == 'dict' else tablename + '_'
+        quote = lambda name: '"%s"' % name.replace('"', '""')
+        self.table = quote(tablename)
+        self.meta = quote(prefix + 'meta')
 
 ##        logger.info("opening Sqlite table %r in %s" % (tablename, filename))
-        self.conn = SqliteMultithread(filename, autocommit=autocommit, journal_mode=journal_mode)
+        self._connargs = dict(autocommit=autocommit, journal_mode=journal_mode,
+                              commit_window=commit_window, commit_size=commit_size)
+        self.conn = SqliteMultithread(filename, **self._connargs)
+        _shelves.add(self)
 
 ##        MAKE_TABLE = 'CREATE TABLE IF NOT EXISTS dict (hash INTEGER PRIMARY KEY, key BLOB, value BLOB)'
-        MAKE_TABLE = 'CREATE TABLE IF NOT EXISTS dict (hash INT NOT NULL, key BLOB, value BLOB)'
+        MAKE_TABLE = 'CREATE TABLE IF NOT EXISTS %s (hash INT NOT NULL, key BLOB, value BLOB)' % self.table
+        self.conn.execute(MAKE_TABLE)
+        MAKE_TABLE = 'CREATE INDEX IF NOT EXISTS %s ON %s (`hash` ASC)' % (quote(prefix + 'id'), self.table)
         self.conn.execute(MAKE_TABLE)
-        MAKE_TABLE = 'CREATE INDEX IF NOT EXISTS `id` ON `dict` (`hash` ASC)'
+        #row count and sizes are maintained by triggers, so that they are available in constant time
+        #note that the REPLACE of an existing row only fires the delete trigger with recursive_triggers on
+        MAKE_TABLE = 'CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY CHECK (id = 0), rows INT, keybytes INT, valuebytes INT)' % self.meta
         self.conn.execute(MAKE_TABLE)
+        for name, event, sign, row in [('insert', 'INSERT', '+', 'NEW'), ('delete', 'DELETE', '-', 'OLD')]:
+            MAKE_TRIGGER = (
+                'CREATE TRIGGER IF NOT EXISTS {trigger} AFTER {event} ON {table} BEGIN '
+                'UPDATE {meta} SET rows = rows {sign} 1, '
+                'keybytes = keybytes {sign} IFNULL(length({row}.key), 0), '
+                'valuebytes = valuebytes {sign} IFNULL(length({row}.value), 0) WHERE id = 0; END'
+                ).format(trigger=quote(prefix + 'meta_' + name), table=self.table, meta=self.meta, event=event, sign=sign, row=row)
+            self.conn.execute(MAKE_TRIGGER)
+        MAKE_TRIGGER = (
+            'CREATE TRIGGER IF NOT EXISTS {trigger} AFTER UPDATE ON {table} BEGIN '
+            'UPDATE {meta} SET '
+            'keybytes = keybytes + IFNULL(length(NEW.key), 0) - IFNULL(length(OLD.key), 0), '
+            'valuebytes = valuebytes + IFNULL(length(NEW.value), 0) - IFNULL(length(OLD.value), 0) WHERE id = 0; END'
+            ).format(trigger=quote(prefix + 'meta_update'), table=self.table, meta=self.meta)
+        self.conn.execute(MAKE_TRIGGER)
+        #initialize the counts of a database created without them; this is the only linear scan
+        INIT_META = ('INSERT OR IGNORE INTO %s (id, rows, keybytes, valuebytes) '
+                     'SELECT 0, COUNT(*), IFNULL(SUM(length(key)), 0), IFNULL(SUM(length(value)), 0) FROM %s') % (self.meta, self.table)
+        self.conn.execute(INIT_META)
+
+        if dedup:
+            MAKE_TABLE = 'CREATE TABLE IF NOT EXISTS blobs (digest BLOB PRIMARY KEY, value BLOB, refs INT NOT NULL, touched REAL)'
+            self.conn.execute(MAKE_TABLE)
+            MAKE_TRIGGER = ("CREATE TRIGGER IF NOT EXISTS blobs_collect AFTER UPDATE OF refs ON blobs "
+                            "WHEN NEW.refs <= 0 AND NEW.touched < strftime('%s', 'now') - 60 BEGIN "
+                            "DELETE FROM blobs WHERE digest = NEW.digest; END")
+            self.conn.execute(MAKE_TRIGGER)
+            refers = "substr({row}.value, 1, 1) = X'00' AND length({row}.value) = 33"
+            count = 'UPDATE blobs SET refs = refs {sign} 1 WHERE %s AND digest = substr({row}.value, 2);' % refers
+            for name, event, body in [
+                    ('insert', 'INSERT',          count.format(sign='+', row='NEW')),
+                    ('delete', 'DELETE',          count.format(sign='-', row='OLD')),
+                    ('update', 'UPDATE OF value', count.format(sign='+', row='NEW') + count.format(sign='-', row='OLD'))]:
+                MAKE_TRIGGER = 'CREATE TRIGGER IF NOT EXISTS %s AFTER %s ON %s BEGIN %s END' % (
+                    quote(prefix + 'blobs_' + name), event, self.table, body)
+                self.conn.execute(MAKE_TRIGGER)
         self.conn.commit()
+        #a table with references to blobs needs them resolved, whether we add to them or not
+        self.dedup = dedup
+        HAS_BLOBS = "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?"
+        self.resolving = bool(self.conn.select_async(HAS_BLOBS, (prefix + 'blobs_insert',)).result())
+        self.value = ("CASE WHEN substr({0}.value, 1, 1) = X'00' THEN (SELECT b.value FROM blobs b WHERE b.digest = substr({0}.value, 2)) "
+                      "ELSE {0}.value END").format(self.table) if self.resolving else 'value'
 
         if flag == 'w':
             self.clear()
 
+    @property
+    def conn(self):
+        """
+        the worker thread owning the connection. a forked child inherits the thread object, but not the thread,
+        and sqlite connections are not to be used across a fork; so a child lazily creates its own
+        """
+        if self._pid != os.getpid() and self._conn is not None:
+            logger.debug('reconnecting %s after fork' % self.filename)
+            self.conn = SqliteMultithread(self.filename, **self._connargs)
+        return self._conn
+    @conn.setter
+    def conn(self, conn):
+        self._conn = conn
+        self._pid = os.getpid()
+
     def __str__(self):
 #        return "SqliteDict(%i items in %s)" % (len(self), self.conn.filename)
         return "SqliteDict(%s)" % (self.conn.filename)
 
     def __len__(self):
         # `select count (*)` is super slow in sqlite (does a linear scan!!)
-        # As a result, len() is very slow too once the table size grows beyond trivial.
-        # We could keep the total count of rows ourselves, by means of triggers,
-        # but that seems too complicated and would slow down normal operation
-        # (insert/delete etc).
-        GET_LEN = 'SELECT COUNT(*) FROM dict'
-        rows = self.conn.select_one(GET_LEN)[0]
-        return rows if rows is not None else 0
+        # so we keep the total count of rows ourselves, by means of triggers
+        GET_LEN = 'SELECT rows FROM %s WHERE id = 0' % self.meta
+        return self.conn.select_one(GET_LEN)[0]
 
     def __bool__(self):
-        GET_LEN = 'SELECT MAX(ROWID) FROM dict'
-        return self.conn.select_one(GET_LEN) is not None
+        return len(self) > 0
+    __nonzero__ = __bool__
+
+    def stats(self):
+        """number of rows, total bytes of encoded keys and values, and size of the file; in constant time"""
+        GET_STATS = 'SELECT rows, keybytes, valuebytes FROM %s WHERE id = 0' % self.meta
+        rows, keybytes, valuebytes = self.conn.select_one(GET_STATS)
+        space = self.space()
+        return dict(rows=rows, key_bytes=keybytes, value_bytes=valuebytes,
+                    file_bytes=space['pages'] * space['page_size'], free_bytes=space['free_pages'] * space['page_size'])
+
+    def _pragma(self, pragma):
+        #pragmas are not selects; queued as such, they would open a group transaction
+        return self.conn.select_async('PRAGMA ' + pragma).result()
+
+    def space(self):
+        """page size, number of pages and number of free pages of the database file, and whether incremental vacuum is enabled"""
+        return dict(
+            page_size   = self._pragma('page_size')[0][0],
+            pages       = self._pragma('page_count')[0][0],
+            free_pages  = self._pragma('freelist_count')[0][0],
+            incremental = self._pragma('auto_vacuum')[0][0] == 2)
+
+    def vacuum(self, pages=None):
+        """return up to `pages` free pages to the filesystem, or all of them. a no-op on databases without incremental vacuum; see compact"""
+        self._pragma('incremental_vacuum(%i)' % pages if pages else 'incremental_vacuum')
+
+    def analyze(self, limit=1000):
+        """update the statistics of the query planner, examining about `limit` rows per index; 0 examines all"""
+        self._pragma('analysis_limit = %i' % limit)     #ignored by sqlite versions predating it
+        self.conn.select_async('ANALYZE').result()
+
+    def check(self, full=False):
+        """
+        list of problems found by an integrity check; ['ok'] if none
+        the check takes time linear in the size of the database. it runs on a connection of its own,
+        rather than holding up the requests queued for this shelve; it only reads, so other readers proceed meanwhile
+        """
+        conn = sqlite3.connect(self.filename, timeout=60)
+        try:
+            return [str(row[0]) for row in conn.execute('PRAGMA integrity_check' if full else 'PRAGMA quick_check')]
+        finally:
+            conn.close()
+
+    def compact(self):
+        """
+        rewrite the database without free pages, enabling incremental vacuum on databases created without it
+        other writers are blocked for the duration; returns a future which resolves once done
+        """
+        return self.conn.vacuum()
+
+    def scan(self, columns, page=256):
+        """
+        iterate over the rows of the table in rowid order, yielding tuples of the requested columns
+
+        rows are fetched a page at a time, each page by a separate query resuming after the last
+        rowid seen, such that memory use is bounded and the worker thread is never held up by
+        a slow consumer. the next page is requested before the current one is handed out,
+        so fetching overlaps with processing, without running ahead more than a page
+        references to blobs in the value column are resolved
+        """
+        columns = [column.replace('value', self.value) for column in columns]
+        GET_PAGE = 'SELECT rowid, %s FROM %s WHERE rowid > ? ORDER BY rowid LIMIT ?' % (', '.join(columns), self.table)
+        request = self.conn.select_async(GET_PAGE, (-2**63, page))
+        while True:
+            rows = request.result()
+            if len(rows) == page:
+                request = self.conn.select_async(GET_PAGE, (rows[-1][0], page))
+            for row in rows:
+                yield row[1:]
+            if len(rows) < page:
+                return
 
     def iterkeys(self):
-        GET_KEYS = 'SELECT key FROM dict ORDER BY rowid'
-        for key in self.conn.select(GET_KEYS):
-            yield decode(key[0])
+        for key, in self.scan(['key']):
+            yield self.decode_key(key)
 
     def itervalues(self):
-        GET_VALUES = 'SELECT value FROM dict ORDER BY rowid'
-        for value in self.conn.select(GET_VALUES):
-            yield decode(value[0])
+        for value, in self.scan(['value']):
+            yield self.decode_value(value)
 
     def iteritems(self):
-        GET_ITEMS = 'SELECT key, value FROM dict ORDER BY rowid'
-        for key, value in self.conn.select(GET_ITEMS):
-            yield decode(key), decode(value)
+        for key, value in self.scan(['key', 'value']):
+            yield self.decode_key(key), self.decode_value(value)
+
+    def iterraw(self):
+        """iterate over (rowid, encoded key, encoded value); rowids as returned by getrowid"""
+        return self.scan(['rowid', 'key', 'value'])
+
+    def iterinfo(self):
+        """iterate over (rowid, key, size of the encoded value in bytes), without touching any value"""
+        for rowid, key, size in self.scan(['rowid', 'key', 'length(value)']):
+            yield rowid, self.decode_key(key), size
+
+    def process_key(self, key):
+        """the stored form of key and the hash it is indexed by; see the module level process_key"""
+        keystr = self.encode_key(key)
+        if not self.exact:
+            keystr = hashing(keystr)
+        return sqlite3.Binary(keystr), canonical.hash64(keystr)
+
+    def decode_key(self, keystr):
+        if not self.exact:
+            raise TypeError('%s stores digests of its keys only' % self)
+        return decode_key(keystr) if self.deterministic else loads(str(keystr))
+
+    encode_value = staticmethod(encode)
+    decode_value = staticmethod(decode)
 
 
     def getrowid(self, key, keystr, keyhash):
-        GET_ITEM = 'SELECT rowid, key FROM dict WHERE hash = ?'
-        keys = self.conn.select(GET_ITEM, (keyhash,))
+        GET_ITEM = 'SELECT rowid, key FROM %s WHERE hash = ?' % self.table
+        with self.metrics.span('sqlite'):
+            keys = list(self.conn.select(GET_ITEM, (keyhash,)))
         for rowid, storedkey in keys:
             if storedkey == keystr:
                 return rowid
@@ -186,58 +416,100 @@ class Shelve(object, DictMixin):
 
     def __contains__(self, key):
         try:
-            self.getrowid(key, *process_key(key))
+            self.getrowid(key, *self.process_key(key))
             return True
         except:
             return False
 
     def __getitem__(self, key):
-        return self.getitem(key, *process_key(key))
+        return self.getitem(key, *self.process_key(key))
     def getitem(self, key, keystr, keyhash):
-        GET_ITEM = 'SELECT key, value FROM dict WHERE hash = ?'
-        items = self.conn.select(GET_ITEM, (keyhash,))
-        if items is None:
-            raise KeyError(key)
+        valuestr = self.getraw(key, keystr, keyhash)
+        with self.metrics.span('decode'):
+            return self.decode_value(valuestr)
+    def getraw(self, key, keystr, keyhash):
+        """the encoded value stored under key"""
+        GET_ITEM = 'SELECT key, %s FROM %s WHERE hash = ?' % (self.value, self.table)
+        with self.metrics.span('sqlite'):
+            items = list(self.conn.select(GET_ITEM, (keyhash,)))
         for storedkey, value in items:
             if keystr == storedkey:
-                return decode(value)
+                if value is None:
+                    #a reference to a blob which went missing
+                    break
+                self.metrics.count('bytes_read', len(value))
+                return value
         raise KeyError(key)
 
     def __setitem__(self, key, value):
-        return self.setitem(key, value, *process_key(key))
+        return self.setitem(key, value, *self.process_key(key))
     def setitem(self, key, value, keystr, keyhash):
-        valuestr = encode(value)
+        with self.metrics.span('encode'):
+            valuestr = self.encode_value(value)
+        self.setraw(key, valuestr, keystr, keyhash)
+    def setraw(self, key, valuestr, keystr, keyhash):
+        """store an already encoded value under key"""
+        self.metrics.count('bytes_written', len(valuestr) + len(keystr))
+        reqs = self._store(key, valuestr, keystr, keyhash)
+        for req, arg in reqs:
+            self.conn.execute(req, arg)
+
+    def _store(self, key, valuestr, keystr, keyhash):
+        """the statements storing an encoded value under key"""
+        reqs = []
+        if self.dedup and len(valuestr) > 64:
+            #small values are not worth the indirection
+            digest = hashlib.sha256(valuestr).digest()
+            #touch before inserting, such that the blob cannot be collected in between
+            reqs.append(('UPDATE blobs SET touched = ? WHERE digest = ?', (time(), sqlite3.Binary(digest))))
+            reqs.append(('INSERT OR IGNORE INTO blobs (digest, value, refs, touched) VALUES (?, ?, 0, ?)',
+                         (sqlite3.Binary(digest), valuestr, time())))
+            valuestr = sqlite3.Binary(REFERENCE + digest)
         try:
             rowid = self.getrowid(key, keystr, keyhash)
-            ADD_ITEM = 'REPLACE INTO dict (rowid, hash, key, value) VALUES (?,?,?,?)'
-            self.conn.execute(ADD_ITEM, (rowid, keyhash, keystr, valuestr))
-        except:
-            ADD_ITEM = 'INSERT INTO dict (hash, key, value) VALUES (?,?,?)'
-            self.conn.execute(ADD_ITEM, (keyhash, keystr, valuestr))
+            reqs.append(('REPLACE INTO %s (rowid, hash, key, value) VALUES (?,?,?,?)' % self.table, (rowid, keyhash, keystr, valuestr)))
+        except KeyError:
+            reqs.append(('INSERT INTO %s (hash, key, value) VALUES (?,?,?)' % self.table, (keyhash, keystr, valuestr)))
+        return reqs
+
+    def setitems(self, items):
+        """
+        write a sequence of (key, value, keystr, keyhash), and block until it is written
+        with autocommit, this is a single transaction, committed before we return;
+        without, the writes join the open transaction, and are committed by commit
+        """
+        reqs = []
+        for key, value, keystr, keyhash in items:
+            with self.metrics.span('encode'):
+                valuestr = self.encode_value(value)
+            self.metrics.count('bytes_written', len(valuestr) + len(keystr))
+            reqs.extend(self._store(key, valuestr, keystr, keyhash))
+        with self.metrics.span('sqlite'):
+            self.conn.executebatch(reqs)
 
     def __delitem__(self, key):
-        self.delitem(key, *process_key(key))
+        self.delitem(key, *self.process_key(key))
     def delitem(self, key, keystr, keyhash):
         rowid = self.getrowid(key, keystr, keyhash)
-        DEL_ITEM = 'DELETE FROM dict WHERE rowid = ?'
+        DEL_ITEM = 'DELETE FROM %s WHERE rowid = ?' % self.table
         self.conn.execute(DEL_ITEM, (rowid,))
 
 
-    def update(self, items=(), **kwds):
-        def dummy(item):
-            key, value = item
-            keystr = encode(key)
-            keyhash = hash_str_to_u64(keystr)
-            valuestr = encode(value)
-            return keyhash, keystr, valuestr
+    def wait(self, key, keystr, keyhash, timeout):
+        """
+        wait for the entry under key to change, or timeout seconds to pass
+        sqlite offers no change notification to other processes, so this simply pauses before polling again
+        """
+        sleep(max(0, min(timeout, 0.01)))
 
+    def update(self, items=(), **kwds):
+        #item by item, such that values are deduplicated and replaced rows keep their rowid, as with setitem
         try:
-            items = map(dummy, items.iteritems())
+            items = items.iteritems()
         except AttributeError:
             pass
-
-        UPDATE_ITEMS = 'REPLACE INTO dict (hash, key, value) VALUES (?, ?, ?)'
-        self.conn.executemany(UPDATE_ITEMS, items)
+        for key, value in items:
+            self[key] = value
         if kwds:
             self.update(kwds)
 
@@ -254,16 +526,27 @@ class Shelve(object, DictMixin):
         return self.iterkeys()
 
     def clear(self):
-        CLEAR_ALL = 'DELETE FROM dict;' # avoid VACUUM, as it gives "OperationalError: database schema has changed"
+        CLEAR_ALL = 'DELETE FROM %s;' % self.table # avoid VACUUM, as it gives "OperationalError: database schema has changed"
         self.conn.commit()
         self.conn.execute(CLEAR_ALL)
         self.conn.commit()
 
+    def collect(self, grace=60):
+        """delete blobs no row refers to, which have not been written to for grace seconds; returns their number"""
+        if not self.resolving:
+            return 0
+        COLLECT = 'DELETE FROM blobs WHERE refs <= 0 AND touched < ?'
+        return self.conn.select_async(COLLECT, (time() - grace,)).result()
+
     def commit(self):
         if self.conn is not None:
-            self.conn.commit()
+            return self.conn.commit()
     sync = commit
 
+    def durable(self):
+        """future resolving once all preceding writes are committed, without forcing a commit"""
+        return self.conn.durable()
+
     def close(self):
         logger.debug("closing %s" % self)
         if self.conn is not None:
@@ -284,17 +567,46 @@ class Shelve(object, DictMixin):
     def __del__(self):
         # like close(), but assume globals are gone by now (such as the logger)
         try:
-            if self.conn is not None:
-                if self.conn.autocommit:
-                    self.conn.conn.commit()
-                self.conn.conn.close()
-                self.conn = None
+            if self._conn is not None and self._pid == os.getpid():
+                if self._conn.autocommit:
+                    self._conn.conn.commit()
+                self._conn.conn.close()
+                self._conn = None
         except:
             pass
 #endclass SqliteDict
 
 
 
+class Future(object):
+    """outcome of a commit or query, which callers can wait for"""
+    def __init__(self):
+        self.event = Event()
+        self.error = None
+        self.value = None
+
+    def set(self, error=None, value=None):
+        self.error = error
+        self.value = value
+        self.event.set()
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """block until committed; returns False upon timeout, and raises if the commit failed"""
+        if not self.event.wait(timeout):
+            return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+    def result(self):
+        """block until done, and return the value or raise the error"""
+        self.wait()
+        return self.value
+
+
 class SqliteMultithread(Thread):
     """
     Wrap sqlite connection in a way that allows concurrent requests from multiple threads.
@@ -302,12 +614,19 @@ class SqliteMultithread(Thread):
     This is done by internally queueing the requests and processing them sequentially
     in a separate thread (in the same order they arrived).
 
+    With a commit_window, autocommit is performed per group rather than per statement;
+    the first write opens a transaction, which is committed once it is commit_window seconds old,
+    or holds commit_size statements. Reads see the writes of the open transaction,
+    but other connections only see them once committed.
+
     """
-    def __init__(self, filename, autocommit, journal_mode):
+    def __init__(self, filename, autocommit, journal_mode, commit_window=None, commit_size=1000):
         super(SqliteMultithread, self).__init__()
         self.filename = filename
         self.autocommit = autocommit
         self.journal_mode = journal_mode
+        self.commit_window = commit_window if autocommit else None
+        self.commit_size = commit_size
         self.reqs = Queue() # use request queue of unlimited size
         self.setDaemon(True) # python2.5-compatible
         self.start()
@@ -317,23 +636,123 @@ class SqliteMultithread(Thread):
             conn = sqlite3.connect(self.filename, isolation_level=None, check_same_thread=False)
         else:
             conn = sqlite3.connect(self.filename, check_same_thread=False)
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')    #only takes effect on creation, or upon VACUUM
         conn.execute('PRAGMA journal_mode = %s' % self.journal_mode)
         conn.text_factory = str
         cursor = conn.cursor()
         cursor.execute('PRAGMA synchronous=OFF')
+        cursor.execute('PRAGMA recursive_triggers=ON')
+
+        grouped = self.commit_window is not None
+        opened = None       #time at which the open group transaction started
+        statements = 0      #number of statements in the open group transaction
+        timer = None        #posts a tick once the open group is due; timed queue reads poll under python 2
+        waiters = []        #futures to be resolved by the next commit
+        failures = []       #errors of statements nobody waited for; reported to the waiters of the next commit
+
+        def commit():
+            if timer is not None:
+                timer.cancel()
+            error = failures[0] if failures else None
+            del failures[:]
+            try:
+                conn.commit()
+            except Exception as e:
+                logger.exception('commit to %s failed' % self.filename)
+                error = error or e
+            for future in waiters:
+                future.set(error)
+            del waiters[:]
+
         while True:
             req, arg, res = self.reqs.get()
-            if req == '--close--':
+
+            if req == '--tick--':
+                #ticks of groups committed in the meantime are ignored
+                if opened is not None and opened == res:
+                    commit()
+                    opened = None
+            elif req == '--close--':
+                if opened is not None:
+                    commit()
                 break
             elif req == '--commit--':
-                conn.commit()
+                waiters.append(res)
+                commit()
+                opened = None
+            elif req == '--durable--':
+                waiters.append(res)
+                if opened is None and self.autocommit:
+                    commit()
+            elif req == '--vacuum--':
+                #VACUUM cannot run inside a transaction
+                if opened is not None:
+                    commit()
+                    opened = None
+                try:
+                    if not self.autocommit:
+                        conn.commit()
+                    cursor.execute('VACUUM')
+                    res.set()
+                except Exception as e:
+                    res.set(e)
+            elif req == '--batch--':
+                #a list of statements to be committed as one; the outcome is reported back
+                if opened is not None:
+                    commit()
+                    opened = None
+                try:
+                    if self.autocommit:
+                        cursor.execute('BEGIN IMMEDIATE')
+                    for batchreq, batcharg in arg:
+                        cursor.execute(batchreq, batcharg)
+                    if self.autocommit:
+                        conn.commit()
+                    res.put(None)
+                except Exception as e:
+                    if self.autocommit:
+                        conn.rollback()
+                    res.put(e)
+            elif isinstance(res, Future):
+                #a query whose rows are returned at once; or for a statement returning no rows,
+                #the number of rows it changed, which is only meaningful right after it ran
+                try:
+                    cursor.execute(req, arg)
+                    res.set(value=cursor.fetchall() if cursor.description is not None else cursor.rowcount)
+                except Exception as e:
+                    res.set(e)
             else:
-                cursor.execute(req, arg)
-                if res:
-                    for rec in cursor:
-                        res.put(rec)
-                    res.put('--no more--')
-                if self.autocommit:
+                try:
+                    if grouped and opened is None and not req.lstrip()[:6].upper() == 'SELECT':
+                        #take the write lock up front; a transaction which has read before it writes
+                        #deadlocks against another process committing, and fails outright
+                        cursor.execute('BEGIN IMMEDIATE')
+                        opened = time()
+                        statements = 0
+                        timer = Timer(self.commit_window, self.reqs.put, [('--tick--', None, opened)])
+                        timer.daemon = True
+                        timer.start()
+                    cursor.execute(req, arg)
+                    if res:
+                        while True:
+                            recs = cursor.fetchmany(256)
+                            if not recs:
+                                break
+                            res.put(recs)
+                        res.put('--no more--')
+                except Exception as e:
+                    #report the error to whoever is waiting for the result, rather than taking down this thread
+                    logger.exception('%s failed on %s' % (req, self.filename))
+                    if res:
+                        res.put(e)
+                    else:
+                        failures.append(e)
+                if opened is not None:
+                    statements += 1
+                    if statements >= self.commit_size:
+                        commit()
+                        opened = None
+                elif self.autocommit:
                     conn.commit()
         conn.close()
 
@@ -348,6 +767,20 @@ class SqliteMultithread(Thread):
         for item in items:
             self.execute(req, item)
 
+    def executebatch(self, reqs):
+        """
+        Execute a list of (req, arg) as a single transaction, and block until it has completed.
+        Raises the sqlite error if the transaction failed, in which case none of it is applied.
+        Without autocommit, the statements are part of the open transaction, and a failure leaves
+        the statements before it in place; it is up to the caller to commit or roll back.
+
+        """
+        res = Queue()
+        self.execute('--batch--', list(reqs), res)
+        error = res.get()
+        if error is not None:
+            raise error
+
     def select(self, req, arg=None):
         """
         Unlike sqlite's native select, this select doesn't handle iteration efficiently.
@@ -355,15 +788,25 @@ class SqliteMultithread(Thread):
         The result of `select` starts filling up with values as soon as the
         request is dequeued, and although you can iterate over the result normally
         (`for res in self.select(): ...`), the entire result will be in memory.
+        Use `select_async` with a LIMIT to page through large results instead.
 
         """
-        res = Queue() # results of the select will appear as items in this queue
+        res = Queue() # results of the select will appear as lists of rows in this queue
         self.execute(req, arg, res)
         while True:
-            rec = res.get()
-            if rec == '--no more--':
+            recs = res.get()
+            if recs == '--no more--':
                 break
-            yield rec
+            if isinstance(recs, Exception):
+                raise recs
+            for rec in recs:
+                yield rec
+
+    def select_async(self, req, arg=None):
+        """Queue a query, and return a Future of the list of its rows; of a statement without rows, the number of rows it changed."""
+        res = Future()
+        self.execute(req, arg, res)
+        return res
 
     def select_one(self, req, arg=None):
         """Return only the first row of the SELECT, or None if there are no matching rows."""
@@ -373,7 +816,22 @@ class SqliteMultithread(Thread):
             return None
 
     def commit(self):
-        self.execute('--commit--')
+        """commit now; returns a future which resolves once done"""
+        future = Future()
+        self.execute('--commit--', res=future)
+        return future
+
+    def durable(self):
+        """future resolving upon the next commit, or right away if nothing is pending"""
+        future = Future()
+        self.execute('--durable--', res=future)
+        return future
+
+    def vacuum(self):
+        """commit, and rewrite the database file; returns a future which resolves once done"""
+        future = Future()
+        self.execute('--vacuum--', res=future)
+        return future
 
     def close(self):
         self.execute('--close--')
@@ -386,7 +844,7 @@ class SqliteMultithread(Thread):
 if __name__ in '__main___':
     logging.basicConfig(format='%(asctime)s : %(levelname)s : %(module)s:%(lineno)d : %(funcName)s(%(threadName)s) : %(message)s')
     logging.root.setLevel(level=logging.INFO)
-    for d in Shelve(r'c:\docs\testdb'), Shelve(r'c:\docs\testdb2', flag='n'):
+    for d in Shelve(tempfile.mktemp()), Shelve(tempfile.mktemp(), flag='n'):
         assert list(d) == []
         assert len(d) == 0
         assert not d
@@ -432,5 +890,5 @@ if __name__ in '__main___':
         assert list(d) == ['q', 'p', 'r']
         d.clear()
         assert not d
-        d.close()
+        d.terminate()
     print 'all tests passed :-)'
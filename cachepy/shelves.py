@@ -14,63 +14,178 @@ which vary in their characteristics
 
 """
 
-class Dict(dict):
-    def __init__(
-            self,
-            determinstic=True,  #type of serialization. deterministic is slower, but necessary for pycc type caching
-            exact=True,         #store full keys, or only their hashes
-            readonly=False
-            ):
-        """
-        light dict wrapper
-        """
-        def err(self, args):
-            raise Exception('This is a readonly mapping')
-        if readonly: self.__setitem__ = err
+import os
+import hashlib
+import threading
+from time import sleep
+import cPickle as pickle
 
-    def __setitem__(self, key, value):
-        key = key   #serialize keys
-        self[key] = value
+import canonical
+from shelve2 import Shelve, Future, encode, decode
+from metrics import select_metrics
+from locking import NullLock
 
 
 class CacheWrapper(object):
     """
     class which wraps a key-value mapping with several (optional) features:
-        locking
-        key serialization
-        hierarchical keying scheme
-
-    shelve should act as a defaultdict(list)
-    it is keyed by a hash of the key
-    if exact is true, a key-value tuple is stored,
-    and keys are checked upon retrieval
+        locking         'file' leaves locking to the lock file of the cache, as a shelve does; 'thread' guards the mapping
+                        with a lock within this process, and None not at all, for single threaded use
+        exact           store full keys, or only their digests; keys take less space, but collisions go unnoticed
+        deterministic   serialize keys canonically, or by cPickle. pickles of equal keys may differ, which costs a miss,
+                        and change between interpreter versions, which costs all of them; fine for caches of a single process
+        hierarchical    store keys by the hierarchy of the cache, or each call under a single key
+        zip             compress the value pickles. to be preferred for long term storage, but not for memoization
 
-    create sqliteresultslist helper type?
-    demand a given interface
-    would like to be able to request a unique id for each key
-    for dict, this is id(key)
-    for sqlite, it is the rowid
-
-
-    we could memoize key serializations within the session
+    together, it implements the interface of shelve2.Shelve which AbstractCache uses, on top of any mapping
+    of strings to strings; a dict, or a shelve.Shelf. a shelve2.Shelve makes these tradeoffs itself
 
+    an entry is identified by a digest of its key, rather than by id(key) or an sqlite rowid,
+    such that the identifiers of entries in persistent mappings survive the process
     """
 
-    def __init__(self, shelve, locking, exact, deterministic, hierarchical, zip = True):
+    def __init__(self, shelve, locking='thread', exact=True, deterministic=True, hierarchical=True, zip=True,
+                 readonly=False, metrics=None):
         self.shelve         = shelve
         self.locking        = locking
-        self.exact          = excact,
+        self.exact          = exact
         self.deterministic  = deterministic
         self.hierarchical   = hierarchical
-        aelf.zip            = True      #zip the key/value pickles. to be preferred for long term storage, but not for memoization
+        self.zip            = zip
+        self.readonly       = readonly
+        self.metrics        = select_metrics(metrics)
+        self.locks_itself   = locking != 'file'
+        self.lock           = threading.RLock() if locking == 'thread' else NullLock()
+        self.seen           = threading.local()     #last value read per thread; see claim
+
         if deterministic:
-            def encode(key):
-                return key
-            def encode(key):
-                return key
+            self.encode_key = canonical.encode
+        else:
+            self.encode_key = lambda key: pickle.dumps(key, -1)
+        self._get, self._set, self._del = shelve.__getitem__, shelve.__setitem__, shelve.__delitem__
+        if exact and deterministic and zip:
+            #entries are stored just as a shelve stores them; see AbstractCache.preload
+            self.iterraw = self._iterraw
+
+    def process_key(self, key):
+        """the key under which an entry is stored, and a hash for the interface of shelve2.process_key"""
+        keystr = self.encode_key(key)
+        if not self.exact:
+            keystr = hashlib.sha256(keystr).digest()
+        return keystr, None
 
-        self.encode = encode
+    @staticmethod
+    def _rowid(keystr):
+        return int(hashlib.sha256(str(keystr)).hexdigest()[:32], 16)
 
+    def getrowid(self, key, keystr, keyhash):
+        with self.lock:
+            self._get(keystr)
+        return self._rowid(keystr)
+
+    def getraw(self, key, keystr, keyhash):
+        with self.lock:
+            valuestr = self._get(keystr)
+        self.seen.keystr, self.seen.valuestr = keystr, valuestr
+        return valuestr
+
+    def getitem(self, key, keystr, keyhash):
+        valuestr = self.getraw(key, keystr, keyhash)
+        with self.metrics.span('decode'):
+            return decode(valuestr) if self.zip else pickle.loads(str(valuestr))
+
+    def setraw(self, key, valuestr, keystr, keyhash):
+        if self.readonly:
+            raise TypeError('This is a readonly mapping')
+        self.metrics.count('bytes_written', len(valuestr) + len(keystr))
+        with self.lock:
+            self._set(keystr, valuestr)
+
+    def setitem(self, key, value, keystr, keyhash):
+        with self.metrics.span('encode'):
+            valuestr = str(encode(value)) if self.zip else pickle.dumps(value, -1)
+        self.setraw(key, valuestr, keystr, keyhash)
+
+    def setitems(self, items):
+        with self.lock:
+            for key, value, keystr, keyhash in items:
+                self.setitem(key, value, keystr, keyhash)
+        self.commit().wait()
+
+    def claim(self, key, value, keystr, keyhash):
+        """
+        write value, provided the entry under key is unchanged since this thread last read it,
+        or absent if it has not read it. returns whether the value was written
+        without locking, this is only as good as the absence of other threads
+        """
+        expected = self.seen.valuestr if getattr(self.seen, 'keystr', None) == keystr else None
+        with self.lock:
+            try:
+                current = self._get(keystr)
+            except KeyError:
+                current = None
+            if current != expected:
+                return False
+            self.setitem(key, value, keystr, keyhash)
+        self.commit().wait()
+        return True
+
+    def delitem(self, key, keystr, keyhash):
+        if self.readonly:
+            raise TypeError('This is a readonly mapping')
+        with self.lock:
+            self._del(keystr)
+
+    def wait(self, key, keystr, keyhash, timeout):
+        sleep(max(0, min(timeout, 0.01)))
+
+    def __getitem__(self, key):
+        return self.getitem(key, *self.process_key(key))
+    def __setitem__(self, key, value):
+        self.setitem(key, value, *self.process_key(key))
+    def __delitem__(self, key):
+        self.delitem(key, *self.process_key(key))
+    def __contains__(self, key):
+        try:
+            self.getrowid(key, *self.process_key(key))
+            return True
+        except KeyError:
+            return False
+    def __len__(self):
+        return len(self.shelve)
+
+    def _iterraw(self):
+        """iterate over (rowid, encoded key, encoded value)"""
+        for keystr, valuestr in self.shelve.items():
+            yield self._rowid(keystr), keystr, valuestr
+
+    def stats(self):
+        return dict(rows=len(self.shelve))
+
+    def clear(self):
+        if self.readonly:
+            raise TypeError('This is a readonly mapping')
+        with self.lock:
+            self.shelve.clear()
+
+    def commit(self):
+        """commit the mapping if it knows how to; returns a future, as a shelve does"""
+        sync = getattr(self.shelve, 'commit', None) or getattr(self.shelve, 'sync', None)
+        future = sync() if sync else None
+        if future is None:
+            future = Future()
+            future.set()
+        return future
+    def sync(self):
+        return self.commit()
+    def durable(self):
+        durable = getattr(self.shelve, 'durable', None)
+        return durable() if durable else self.commit()
+
+    def close(self):
+        close = getattr(self.shelve, 'close', None)
+        if close:
+            close()
 
 
 
@@ -78,35 +193,126 @@ def select_mapping(
         local=True,         #if true, sqlite, else remote server
         ondisk=True,        #persistent disk based or per session in mem cache
         readonly=False,     #whether writing keys is allowed
-        locking='file',     #locking scheme used to regulate access for local ondisk backends
+        locking='file',     #locking scheme used to regulate access for local ondisk backends; 'file', 'thread' or None
 
-        hierarchical=False, #hierarchical key storage scheme
-        determinstic=True,  #type of serialization. deterministic is slower, but necessary for pycc type caching
+        hierarchical=True,  #hierarchical key storage scheme
+        deterministic=True, #type of serialization. deterministic is slower, but necessary for pycc type caching
         exact=True,         #store full keys, or only their hashes
+        zip=True,           #compress values
+        address=None,       #address of the cache server, if not local
+        path=None,          #file built by readonlyshelve.ReadOnlyShelve.build, if readonly
         ):
     """
     select a key-value mapping with the appropriate chacteristics
-    shelve2 is the most general implementation thus far,
-    but there are many functionality/performance tradeoffs to be made
+    returns a function opening it, given the filename of a cache and the keyword arguments of shelve2.Shelve
+
+    a sqlite shelve guarded by a lock file makes the tradeoffs on keys and values natively;
+    there, dropping exact keys or compression saves space foremost. a lookup is dominated by the lock file
+    and the round trip to sqlite, next to which encoding keys and values takes little time.
+    the time is saved by dropping persistence or locking across processes; a dict, or a python shelve
+    used by a single process, which a CacheWrapper gives the interface of a shelve
+
+    a readonly mapping is a pycc file, built once by ReadOnlyShelve.build from (call, value) pairs;
+    a call being the tuple of positional arguments, followed by a dict of the keyword arguments if any.
+    a cache on top of it stores nothing; calls not in the file are computed every time
     """
-    if readonly or not local: locking = None
+    if not local:
+        #the server does everything its own way
+        from server import RemoteShelve
+        return lambda filename, metrics=None, **kwargs: RemoteShelve(address, os.path.basename(filename), metrics=metrics)
+
+    if readonly:
+        if not ondisk or path is None:
+            raise ValueError('A readonly mapping is a file built by ReadOnlyShelve.build; pass its path')
+        from readonlyshelve import ReadOnlyShelve, hashing
+        def open_pycc(filename, metrics=None, **kwargs):
+            wrapper = CacheWrapper(ReadOnlyShelve(path).shelve, None, exact=False, hierarchical=False, zip=False,
+                                   readonly=True, metrics=metrics)
+            #build keys each call by the digest of its arguments; the cache looks up (parent, call) pairs
+            wrapper.encode_key = lambda key: key
+            wrapper.process_key = lambda key: (hashing(key[1]), None)
+            return wrapper
+        return open_pycc
+
+    if ondisk and locking == 'file':
+        def open_shelve(filename, **kwargs):
+            shelve = Shelve(filename, exact=exact, deterministic=deterministic, zip=zip, **kwargs)
+            if not hierarchical:
+                shelve.hierarchical = False     #which AbstractCache abides by
+            return shelve
+        return open_shelve
+
+    def open(filename, metrics=None, **kwargs):
+        if ondisk:
+            #no lock file; a single process store
+            import shelve
+            mapping = shelve.open(filename + '.shelf', protocol=-1)
+        else:
+            mapping = {}
+        return CacheWrapper(mapping, locking, exact, deterministic, hierarchical, zip, readonly, metrics)
+    return open
+
 
-    if local and ondisk and determinstic and exact:
-        import shelve2
-        return shelve2.Shelve
 
-    if readonly and ondisk and local and not exact and determinstic:
-        import ReadOnlyShelve
-        return ReadOnlyShelve.Shelve
+if __name__=='__main__':
+    import tempfile
+    from time import time
+    from cache import AbstractCache
+    from readonlyshelve import ReadOnlyShelve
 
-    if not locking and local and ondisk:
-        #create shelve wrapper with different accessors
-        import shelve
-        return shelve.Shelf
+    class Square(AbstractCache):
+        identifier = 'shelves_demo'
+        def environment(self):
+            return 'demo'
+        def operation(self, x, y=0):
+            return x * x + y
 
-    if local and not ondisk:
-        return lambda args: Dict(determinstic, exact, readonly)
+    fast = dict(deterministic=False, zip=False, hierarchical=False)
+    specs = [
+        #sqlite under a lock file
+        dict(),
+        dict(zip=False, exact=False),
+        dict(fast),
+        #a python shelve, for a single process
+        dict(locking='thread'),
+        dict(fast, locking=None),
+        #a dict
+        dict(fast, ondisk=False, locking='thread'),
+        dict(fast, ondisk=False, locking=None),
+    ]
+    for spec in specs:
+        cache = Square(mapping=spec, hierarchy=[[0]], environment_clear=True, connect_clear=True)
+        assert cache(3, y=1) == cache(3, y=1) == 10 and cache(4) == 16
+        for i in range(20):
+            cache(i, y=1)
+        start = time()
+        for i in range(200):
+            cache(i % 20, y=1)
+        print '%-70r %.1f us per hit' % (spec, (time() - start) / 200 * 1e6)
+        assert all(cache(i, y=1) == i * i + 1 for i in range(20))
+        cache.flush()
 
+    #values written behind end up under the keys they are looked up by, in wrapped mappings too
+    for spec in [dict(locking='thread'), dict(fast, ondisk=False, locking=None)]:
+        calls = []
+        class Logged(Square):
+            def operation(self, x, y=0):
+                calls.append(x)
+                return x * x + y
+        cache = Logged(mapping=spec, hierarchy=[[0]], write_behind=True, deferred_timeout=1, connect_clear=True)
+        assert cache(5) == 25
+        cache.flush()
+        assert cache(5) == 25 and calls == [5]
 
+    #entries of a persistent mapping survive the process
+    cache = Square(mapping=dict(locking='thread'), hierarchy=[[0]], environment_clear=False)
+    assert cache(3, y=1) == 10 and cache.stats()['storage']['rows'] > 1
 
-    raise NotImplementedError('No key value store matching these criteria has been found')
\ No newline at end of file
+    #a prebuilt pycc file serves the calls it holds, and computes the others
+    path = tempfile.mktemp()
+    ReadOnlyShelve.build(path, [((3,), 'built'), ((4, {'y': 1}), 'built too')])
+    cache = Square(mapping=dict(readonly=True, path=path), metrics=True)
+    assert cache(3) == 'built' and cache(4, y=1) == 'built too' and cache(5) == 25
+    counters = cache.metrics.snapshot()['counters']
+    assert counters['hit'] == 2 and counters['miss'] == 1
+    print 'all tests passed'
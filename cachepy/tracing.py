@@ -0,0 +1,222 @@
+
+"""
+recording of cache accesses, and warming up a cache from such a trace
+
+after a deploy or a change of environment, a cache starts out empty, and every worker process
+runs into the same expensive misses at once. a trace records which arguments a cache is called with,
+how often, and what computing them cost; warm replays those calls on the fresh cache ahead of time,
+most valuable first, on a pool of processes
+
+traces are aggregated per call, keyed by the digest of its canonical key, rather than logged per event;
+their size is bounded by the number of distinct calls. the arguments of each call are pickled
+the first time it is seen; calls whose arguments do not pickle are counted, but cannot be replayed.
+recording buffers in memory, and writes to its sqlite file about once per flush interval,
+on a thread of its own, and at exit
+
+the trace of a cache is independent of its environment, so it survives the clearing of the cache
+to warm up the module level cache of some module from the command line:
+    python tracing.py mypackage.mymodule mycache --workers 8
+"""
+
+import os
+import sys
+import atexit
+import sqlite3
+import threading
+import logging
+from time import time
+import cPickle as pickle
+
+logger = logging.getLogger(__name__)
+
+
+class Trace(object):
+    """aggregated record of the calls to a cache, stored in an sqlite file"""
+
+    def __init__(self, filename, flush_interval=1.0):
+        self.filename       = filename
+        self.flush_interval = flush_interval
+        self.pid            = os.getpid()
+        self.lock           = threading.Lock()
+        self.buffer         = {}        #digest -> [pickled args, count, cost, first, last]
+        self.flushed        = time()
+        self.flushing       = False     #whether a background flush is underway
+        conn = self._connect()
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS trace (digest BLOB PRIMARY KEY, args BLOB, count INT, cost REAL, first REAL, last REAL)')
+        finally:
+            conn.close()
+        atexit.register(self.flush)
+
+    def _connect(self):
+        #records are flushed from whichever thread happens to call; connections do not cross threads
+        conn = sqlite3.connect(self.filename, timeout = 60)
+        conn.text_factory = str
+        return conn
+
+    def record(self, digest, args, kwargs):
+        """count a call"""
+        if self.pid != os.getpid():
+            #a forked child; the buffer is the parent's to flush
+            self.pid, self.lock, self.buffer, self.flushing = os.getpid(), threading.Lock(), {}, False
+        now = time()
+        with self.lock:
+            entry = self.buffer.get(digest)
+            if entry is None:
+                try:
+                    snapshot = pickle.dumps((args, kwargs), -1)
+                except Exception:
+                    snapshot = None
+                entry = self.buffer[digest] = [snapshot, 0, None, now, now]
+            entry[1] += 1
+            entry[4] = now
+            due = now - self.flushed > self.flush_interval and not self.flushing
+            if due:
+                self.flushing = True
+        if due:
+            #the caller may be on the hit path of a cache, and the trace database may be busy for a while
+            flusher = threading.Thread(target = self._flush_behind)
+            flusher.daemon = True
+            flusher.start()
+
+    def _flush_behind(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.warning('Flushing trace %s failed', self.filename, exc_info=True)
+        finally:
+            self.flushing = False
+
+    def computed(self, digest, cost):
+        """record the time in seconds it took to compute a call"""
+        with self.lock:
+            entry = self.buffer.get(digest)
+            if entry is None:
+                #flushed in the meantime
+                entry = self.buffer[digest] = [None, 0, None, time(), time()]
+            entry[2] = cost
+
+    def flush(self):
+        """write buffered records to disk"""
+        with self.lock:
+            buffer, self.buffer = self.buffer, {}
+            self.flushed = time()
+        if not buffer:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    'INSERT OR IGNORE INTO trace (digest, args, count, cost, first, last) VALUES (?, NULL, 0, NULL, ?, ?)',
+                    [(sqlite3.Binary(digest), first, last) for digest, (args, count, cost, first, last) in buffer.iteritems()])
+                conn.executemany(
+                    'UPDATE trace SET args = IFNULL(args, ?), count = count + ?, cost = IFNULL(?, cost), last = ? WHERE digest = ?',
+                    [(args and sqlite3.Binary(args), count, cost, last, sqlite3.Binary(digest))
+                     for digest, (args, count, cost, first, last) in buffer.iteritems()])
+        finally:
+            conn.close()
+
+    def ranked(self, limit=None, since=None):
+        """
+        list of (args, kwargs, count, cost) of the recorded calls, in order of the total time they cost,
+        as count times cost. calls which have not been computed while tracing are assumed to cost the average
+        since optionally restricts the calls to those seen within that many seconds
+        """
+        calls = []
+        for digest, args, count, cost in self._ranked(since, 'args IS NOT NULL')[:limit]:
+            try:
+                args, kwargs = pickle.loads(str(args))
+            except Exception:
+                logger.warning('Unable to unpickle traced arguments; skipping them', exc_info=True)
+                continue
+            calls.append((args, kwargs, count, cost))
+        return calls
+
+    def hottest(self, limit=None, since=None):
+        """digests of the canonical keys of the recorded calls, ranked as by ranked"""
+        return [digest for digest, args, count, cost in self._ranked(since)[:limit]]
+
+    def _ranked(self, since=None, where='1'):
+        self.flush()
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT digest, args, count, cost FROM trace WHERE %s AND last >= ?' % where,
+                                (0 if since is None else time() - since,)).fetchall()
+        finally:
+            conn.close()
+        costs = [cost for digest, args, count, cost in rows if cost is not None]
+        average = sum(costs) / len(costs) if costs else 1.0
+        rows = [(str(digest), args, count, average if cost is None else cost) for digest, args, count, cost in rows]
+        rows.sort(key=lambda row: row[2] * row[3], reverse=True)
+        return rows
+
+    def __len__(self):
+        self.flush()
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT COUNT(*) FROM trace').fetchone()[0]
+        finally:
+            conn.close()
+
+
+def _warm_one(call):
+    cache, args, kwargs = call
+    try:
+        cache(*args, **kwargs)
+        return True
+    except Exception:
+        logger.debug('Warming up %s%r failed', cache.identifier, args, exc_info=True)
+        return False
+
+def warm(cache, trace=None, workers=4, processes=True, limit=None, since=None):
+    """
+    replay the calls recorded in trace on cache, most valuable first; by default, the trace of the cache itself
+    a cache computes one value at a time per process, so calls are spread over a pool of processes,
+    unless processes is False. returns the number of calls replayed and the number that raised
+    """
+    import multiprocessing
+    import multiprocessing.dummy
+    from cache import prepare_fork
+    cache = getattr(cache, 'cache', cache)     #a decorated function
+    if trace is None:
+        trace = cache.trace
+    if isinstance(trace, basestring):
+        trace = Trace(trace)
+    calls = trace.ranked(limit, since)
+    #replaying is not to be recorded; the pool processes inherit this at fork
+    recording, cache.trace = cache.trace, None
+    try:
+        if processes:
+            prepare_fork()
+            pool = multiprocessing.Pool(workers)
+        else:
+            pool = multiprocessing.dummy.Pool(workers)
+        try:
+            outcomes = pool.map(_warm_one, [(cache, args, kwargs) for args, kwargs, count, cost in calls], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        cache.trace = recording
+    failed = outcomes.count(False)
+    logger.info('Warmed up %s with %i calls, of which %i failed', cache.identifier, len(calls), failed)
+    return len(calls), failed
+
+
+
+if __name__=='__main__':
+    import importlib
+    args = sys.argv[1:]
+    options = dict(workers=4, limit=None)
+    for name in options:
+        if '--' + name in args:
+            i = args.index('--' + name)
+            options[name] = int(args[i+1])
+            del args[i:i+2]
+    if len(args) != 2:
+        print 'usage: python tracing.py module name [--workers N] [--limit N]'
+        sys.exit(2)
+    logging.basicConfig(level=logging.INFO)
+    module, name = args
+    cache = getattr(importlib.import_module(module), name)
+    print 'replayed %i calls, of which %i failed' % warm(cache, **options)
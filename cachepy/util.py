@@ -2,13 +2,188 @@
 cachepy utility functions
 
 we may commonly want to read a folder hierarchy of files from disk
+for instance, to capture the entire source code of a compiler in the environment of a cache
+
+read_directory fingerprints a directory tree by the content of its files
+file contents are hashed in parallel, and digests are remembered in a small sqlite database,
+keyed by (path, size, mtime, inode); unchanged files are never read again.
+files modified within the resolution of mtime of the scan could change again unnoticed;
+those are hashed, but not remembered, until they have been left alone for a while
+the resulting Fingerprint provides a __cache_key__, so it can be used as (part of) an environment or key
 """
 
 import cPickle as Pickle
 
 pickle_protocol = -1        #set to 2 for python 2/3 compatibility
 
-def read_directory(root, whitelist, blacklist):
-    import os
-    return
+import os
+import fnmatch
+import hashlib
+import sqlite3
+import tempfile
+from time import time
+
+_racy = 2       #seconds within which a modification may not show in the mtime of a file
+
+
+def _statcache_path():
+    path = os.path.join(tempfile.gettempdir(), 'cachepy')
+    try:
+        os.mkdir(path)
+    except OSError:
+        pass
+    return os.path.join(path, 'fingerprints')
+
+
+def _matches(relpath, patterns):
+    """patterns match either the path relative to the root, or the file name"""
+    name = os.path.basename(relpath)
+    return any(fnmatch.fnmatch(relpath, p) or fnmatch.fnmatch(name, p) for p in patterns)
+
+
+def _hash_file(path, blocksize=2**20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                return h.digest()
+            h.update(block)
+
+
+class Fingerprint(object):
+    """
+    content fingerprint of a directory tree
+    files is a sorted tuple of (relative path, sha256 digest) pairs
+    """
+    def __init__(self, root, files):
+        self.root   = root
+        self.files  = tuple(files)
+        h = hashlib.sha256()
+        for path, digest in self.files:
+            h.update(path.encode('utf-8') if isinstance(path, unicode) else path)
+            h.update('\x00')
+            h.update(digest)
+        self.digest = h.digest()
+
+    def __cache_key__(self):
+        #the root itself is irrelevant; an identical copy elsewhere has the same fingerprint
+        return self.digest
+
+    def __len__(self):
+        return len(self.files)
+    def __nonzero__(self):
+        #a fingerprint of an empty tree is a fingerprint all the same; not an absent environment
+        return True
+    def __iter__(self):
+        return iter(self.files)
+    def __eq__(self, other):
+        return isinstance(other, Fingerprint) and self.digest == other.digest
+    def __ne__(self, other):
+        return not self == other
+    def __hash__(self):
+        return hash(self.digest)
+    def __repr__(self):
+        return 'Fingerprint(%r, %i files, %s)' % (self.root, len(self.files), self.digest.encode('hex')[:16])
+
+
+def read_directory(root, whitelist=('*',), blacklist=(), threads=8, statcache=True):
+    """
+    fingerprint all files under root matching any of the whitelist glob patterns,
+    and none of the blacklist patterns. directories matching the blacklist are skipped entirely
+
+    statcache is the filename of the database remembering digests of unchanged files;
+    True selects a default location, and False disables it
+    """
+    root = os.path.abspath(root)
+    if isinstance(whitelist, basestring): whitelist = [whitelist]
+    if isinstance(blacklist, basestring): blacklist = [blacklist]
+
+    #gather stats of all files of interest
+    scanned = time()
+    stats = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        reldir = os.path.relpath(dirpath, root)
+        reldir = '' if reldir == os.curdir else reldir.replace(os.sep, '/') + '/'
+        dirnames[:] = [d for d in dirnames if not _matches(reldir + d, blacklist)]
+        for name in filenames:
+            relpath = reldir + name
+            if _matches(relpath, whitelist) and not _matches(relpath, blacklist):
+                st = os.stat(os.path.join(dirpath, name))
+                stats[relpath] = st.st_size, st.st_mtime, st.st_ino
+
+    #look up digests of files which have not changed since we last saw them
+    conn = None
+    known = {}
+    if statcache:
+        conn = sqlite3.connect(_statcache_path() if statcache is True else statcache, timeout=60)
+        conn.text_factory = str
+        conn.execute('CREATE TABLE IF NOT EXISTS stats (root TEXT, path TEXT, size INT, mtime REAL, inode INT, digest BLOB, PRIMARY KEY (root, path))')
+        for path, size, mtime, inode, digest in conn.execute('SELECT path, size, mtime, inode, digest FROM stats WHERE root = ?', (root,)):
+            known[path] = (size, mtime, inode), str(digest)
+
+    digests = {}
+    changed = []
+    for relpath, stat in stats.iteritems():
+        try:
+            oldstat, digest = known[relpath]
+            if oldstat == stat:
+                digests[relpath] = digest
+                continue
+        except KeyError:
+            pass
+        changed.append(relpath)
+
+    #hash the remainder in parallel; hashlib and file io release the gil
+    if changed:
+        paths = [os.path.join(root, *relpath.split('/')) for relpath in changed]
+        if threads > 1 and len(changed) > 1:
+            import multiprocessing.dummy
+            pool = multiprocessing.dummy.Pool(min(threads, len(changed)))
+            try:
+                hashes = pool.map(_hash_file, paths)
+            finally:
+                pool.close()
+        else:
+            hashes = map(_hash_file, paths)
+        digests.update(zip(changed, hashes))
+
+    if conn is not None:
+        racy = set(p for p in changed if stats[p][1] > scanned - _racy)
+        with conn:
+            conn.executemany(
+                'REPLACE INTO stats (root, path, size, mtime, inode, digest) VALUES (?,?,?,?,?,?)',
+                [(root, p) + stats[p] + (sqlite3.Binary(digests[p]),) for p in changed if p not in racy])
+            vanished = [(root, p) for p in known if p not in stats or p in racy]
+            conn.executemany('DELETE FROM stats WHERE root = ? AND path = ?', vanished)
+        conn.close()
+
+    return Fingerprint(root, sorted(digests.iteritems()))
+
+
+
+if __name__=='__main__':
+    from time import time
+    root = os.path.dirname(os.path.abspath(__file__))
+    for i in range(2):
+        t = time()
+        fingerprint = read_directory(root, whitelist='*.py', blacklist=['*.pyc', '.git'])
+        print fingerprint, time() - t
 
+    #a file rewritten within the resolution of its mtime is not mistaken for unchanged
+    import shutil
+    scratch = tempfile.mkdtemp()
+    try:
+        assert read_directory(scratch)      #empty, but a fingerprint nonetheless
+        path = os.path.join(scratch, 'a.txt')
+        with open(path, 'w') as f:
+            f.write('one')
+        stat = os.stat(path)
+        before = read_directory(scratch)
+        with open(path, 'w') as f:
+            f.write('two')
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+        assert read_directory(scratch) != before
+    finally:
+        shutil.rmtree(scratch)
+    print 'all tests passed'